@@ -1,19 +1,41 @@
 import sys
 import os
-import sqlite3
-import random
 import webbrowser
 import getpass
 import threading
+import time
+import argparse
+import logging
+import traceback
+import cProfile
+import hashlib
+import math
+import json
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
 from datetime import datetime
+
+# A second launch only hands its arguments to the running MikuAI, do that before loading Qt
+from mikucore import forward_to_running_instance
+if __name__ == "__main__" and not {"-h", "--help"} & set(sys.argv) and forward_to_running_instance(sys.argv[1:]):
+    sys.exit(0)
+
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                            QHBoxLayout, QListWidget, QListWidgetItem, QLineEdit, 
                            QPushButton, QDialog, QLabel, QCheckBox, QTextEdit,
                            QMessageBox, QFrame, QSystemTrayIcon, QMenu, QTabWidget,
-                           QScrollArea, QSplitter)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QTimer
-from PyQt6.QtGui import QIcon, QFont, QPalette, QColor, QAction, QCloseEvent
-from chatgpt_wrapper import ChatGPT
+                           QScrollArea, QSplitter, QAbstractItemView, QInputDialog,
+                           QTableWidget, QTableWidgetItem, QHeaderView, QSpinBox, QFormLayout)
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QTimer, QObject, QEvent, QSize, QRectF
+from PyQt6.QtNetwork import QLocalServer, QLocalSocket
+from PyQt6.QtGui import (QIcon, QFont, QPalette, QColor, QAction, QCloseEvent, QPainter,
+                         QTextDocument, QTextCursor, QTextCharFormat, QTextFormat,
+                         QAbstractTextDocumentLayout)
+from mikucore import (DATA_DIR, ChatDatabase, IdleJob, AutoTitleJob, VacuumJob, AutoVacuumSwitchJob,
+                      HedgedBackend, PrefetchCache, predict_next_chats, load_backend_factory,
+                      build_personality_prompt, mikuify_response, split_miku_response, format_chat_error,
+                      count_tokens, estimate_cost, check_budgets, PersonaSession, instance_socket_path,
+                      instance_socket_is_ours)
 
 # Try to import speech recognition
 try:
@@ -22,32 +44,60 @@ try:
 except ImportError:
     SPEECH_AVAILABLE = False
 
+# Try to import pygments for code block highlighting
+try:
+    from pygments.lexers import get_lexer_by_name
+    from pygments.styles import get_style_by_name
+    from pygments.util import ClassNotFound
+    PYGMENTS_AVAILABLE = True
+except ImportError:
+    PYGMENTS_AVAILABLE = False
+
+# Bubbles are laid out for widths rounded down to this many pixels, so
+# dragging the window edge does not re-layout every message on every pixel
+WIDTH_BUCKET = 40
+
+# Messages longer than this are shown as a collapsed preview; the full text
+# stays in the database until the user expands it
+LARGE_MESSAGE_CHARS = 8000
+PREVIEW_CHARS = 2000
+PREVIEW_LINES = 25
+
 class ChatWorker(QThread):
     response_ready = pyqtSignal(str)
+    usage_ready = pyqtSignal(int, int, float, int)  # prompt tokens, response tokens, latency ms, hedges
+    persona_usage_ready = pyqtSignal(int, int, float)
+    failed = pyqtSignal()
     
-    def __init__(self, message, chatgpt_instance, username):
+    def __init__(self, message, chatgpt_instance, username, persona=None, backends=()):
         super().__init__()
         self.message = message
         self.chatgpt = chatgpt_instance
         self.username = username
+        self.persona = persona  # Set when the backends have to be primed again first
+        self.backends = backends
         
     def run(self):
         try:
+            if self.persona:
+                prompt_tokens = count_tokens(build_personality_prompt(self.username))
+                for index, backend in enumerate(self.backends):
+                    started = time.perf_counter()
+                    setup_response = self.persona.resume_or_prime(backend, index)
+                    if setup_response is not None:
+                        latency_ms = (time.perf_counter() - started) * 1000
+                        self.persona_usage_ready.emit(prompt_tokens, count_tokens(setup_response), latency_ms)
+            started = time.perf_counter()
             response = self.chatgpt.ask(self.message)
-            # FORCE MIKU MODE
-            miku_responses = [
-                f"*giggles* {response} ~desu! (◕‿◕✿)",  
-                f"Nya~! {response} ☆⌒ヽ(*'､^*)chu",  
-                f"Hmm... *taps chin* {response} ...Mou, ii kai? (；一_一)",  
-                f"*singing* 🎵 {response} 🎵 ...Eh? Did I get it right? (• ω •)",  
-                f"B-baka! It's not like I'm helping you because I like you or anything! >_< ...{response}"
-            ]
-            miku_response = random.choice(miku_responses)
-            self.response_ready.emit(miku_response)
+            latency_ms = (time.perf_counter() - started) * 1000
+            # A hedged request went to more than one backend and each of them bills it
+            hedges = max(0, getattr(self.chatgpt, "last_backends_asked", 1) - 1)
+            # Count here rather than on the GUI thread, long answers take a while to tokenize
+            self.usage_ready.emit(count_tokens(self.message), count_tokens(response), latency_ms, hedges)
+            self.response_ready.emit(mikuify_response(response))
         except Exception as e:
-            error_msg = f"*cries* Error-chan appeared: {str(e)}... Miku can't connect to the digital world! (╥﹏╥)"
-            error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
-            self.response_ready.emit(error_msg)
+            self.failed.emit()
+            self.response_ready.emit(format_chat_error(e))
 
 class VoiceWorker(QThread):
     voice_ready = pyqtSignal(str)
@@ -80,95 +130,417 @@ class VoiceWorker(QThread):
             error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
             self.voice_ready.emit(error_msg)
 
-class ChatDatabase:
-    def __init__(self):
-        self.db_dir = os.path.expanduser("~/.local/share/miku")
-        os.makedirs(self.db_dir, exist_ok=True)
-        self.db_path = os.path.join(self.db_dir, "mikuai1.db")
-        self.init_db()
-        
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create chats table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Create messages table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                sender TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats (id)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
-        
-    def create_chat(self, name):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO chats (name) VALUES (?)", (name,))
-        chat_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return chat_id
-        
-    def get_chats(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, created_at FROM chats ORDER BY created_at DESC")
-        chats = cursor.fetchall()
-        conn.close()
-        return chats
-        
-    def get_messages(self, chat_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT sender, message, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp", (chat_id,))
-        messages = cursor.fetchall()
-        conn.close()
-        return messages
-        
-    def add_message(self, chat_id, sender, message):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO messages (chat_id, sender, message) VALUES (?, ?, ?)", 
-                      (chat_id, sender, message))
-        conn.commit()
-        conn.close()
-        
-    def delete_chat(self, chat_id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-        conn.commit()
-        conn.close()
-        
-    def rename_chat(self, chat_id, new_name):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE chats SET name = ? WHERE id = ?", (new_name, chat_id))
-        conn.commit()
-        conn.close()
+class IdleScheduler(QObject):
+    """Runs registered IdleJobs in small slices while the user is away.
+    
+    The app counts as idle when the window is hidden to the tray or no input
+    arrived for a job's idle_seconds. Each tick runs at most one slice of one
+    job, bounded by a wall-clock and an I/O (rows/pages) budget, and the job's
+    state is persisted after every slice. Jobs run on the main thread, so a
+    returning user waits for at most one slice before Miku reacts. Jobs that
+    hand work to a thread get interrupt() called the moment the user is back,
+    or when quiet() is called before Miku writes to the database herself.
+    Exclusive jobs wait until no chat request is in flight.
+    """
+    INPUT_EVENTS = {
+        QEvent.Type.KeyPress, QEvent.Type.MouseButtonPress, QEvent.Type.MouseMove,
+        QEvent.Type.Wheel, QEvent.Type.TouchBegin, QEvent.Type.InputMethod,
+        QEvent.Type.WindowActivate,
+    }
+    
+    def __init__(self, window, db, tick_ms=250, time_budget_ms=20, io_budget=200):
+        super().__init__(window)
+        self.window = window
+        self.db = db
+        self.time_budget = time_budget_ms / 1000
+        self.io_budget = io_budget
+        self.jobs = []
+        self.states = {}
+        self.waiting = set()  # Jobs with work running off the GUI thread
+        self.requests = 0  # Chat requests whose answers still have to be saved
+        self.last_input = time.monotonic()
+        
+        QApplication.instance().installEventFilter(self)
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+        self.timer.start(tick_ms)
+        
+    def register(self, job):
+        if job.persistent:
+            state, last_finished = self.db.get_job_state(job.name)
+        else:
+            state, last_finished = None, None
+        self.states[job.name] = (state, last_finished)
+        self.jobs.append(job)
+        
+    def wake(self, name):
+        """Make a job due again right away, dropping any half-done run"""
+        self.states[name] = (None, None)
+        
+    def eventFilter(self, obj, event):
+        if event.type() in self.INPUT_EVENTS:
+            self.last_input = time.monotonic()
+            self.quiet()
+        return False
+        
+    def quiet(self):
+        """Call before using the database on the GUI thread: stops jobs that may hold it locked"""
+        if self.waiting:
+            for job in self.waiting:
+                job.interrupt()
+            self.waiting.clear()
+            
+    def request_started(self):
+        self.quiet()
+        self.requests += 1
+        
+    def request_finished(self):
+        self.requests = max(0, self.requests - 1)
+        
+    def idle_for(self):
+        if self.window.isHidden():
+            return float("inf")
+        return time.monotonic() - self.last_input
+        
+    def is_due(self, job):
+        state, last_finished = self.states[job.name]
+        if state is not None or last_finished is None:
+            return True  # Unfinished or never ran
+        return time.time() - last_finished >= job.interval
+        
+    def tick(self):
+        idle = self.idle_for()
+        # While an exclusive job holds the database nothing else may touch it
+        jobs = [job for job in self.waiting if job.exclusive] or self.jobs
+        for job in jobs:
+            if job.exclusive and self.requests:
+                continue
+            if idle >= job.idle_seconds and self.is_due(job):
+                self.run_slice(job)
+                break
+                
+    def run_slice(self, job):
+        state, last_finished = self.states[job.name]
+        # Wall clock, not CPU time: fsyncs and other disk waits count against the slice too
+        started = time.perf_counter()
+        io_used = 0
+        done = False
+        
+        try:
+            while True:
+                state, done, rows = job.step(self.db, state)
+                if rows is None:
+                    self.waiting.add(job)
+                    break
+                self.waiting.discard(job)
+                io_used += rows
+                if done:
+                    break
+                if time.perf_counter() - started >= self.time_budget or io_used >= self.io_budget:
+                    break
+        except Exception as e:
+            error_msg = f"Error in idle job {job.name}: {e}"
+            error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
+            print(error_msg)  # Debug log
+            # Give up on this run and retry after the normal interval
+            state, done = None, True
+            
+        if done:
+            if job.persistent:
+                self.db.save_job_state(job.name, None, finished=True)
+            self.states[job.name] = (None, time.time())
+        else:
+            if job.persistent:
+                self.db.save_job_state(job.name, state)
+            self.states[job.name] = (state, last_finished)
+
+def width_bucket(width):
+    return max(WIDTH_BUCKET, width // WIDTH_BUCKET * WIDTH_BUCKET)
+
+def message_hash(message):
+    return hashlib.sha1(message.encode("utf-8", "surrogatepass")).hexdigest()
+
+def highlight_code_blocks(doc, dark):
+    """Colour fenced code blocks that name their language (```python ...)"""
+    if not PYGMENTS_AVAILABLE:
+        return
+        
+    style = get_style_by_name("monokai" if dark else "friendly")
+    cursor = QTextCursor(doc)
+    block = doc.begin()
+    while block.isValid():
+        language = block.blockFormat().stringProperty(QTextFormat.Property.BlockCodeLanguage)
+        if not language:
+            block = block.next()
+            continue
+            
+        # Collect the whole fence so multi-line strings and comments lex correctly
+        start = block.position()
+        lines = []
+        while block.isValid() and block.blockFormat().stringProperty(QTextFormat.Property.BlockCodeLanguage) == language:
+            lines.append(block.text())
+            block = block.next()
+            
+        try:
+            # Token offsets must line up with the document: no stripped or added newlines
+            lexer = get_lexer_by_name(language, stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            continue
+            
+        code = "\n".join(lines)
+        offset = 0
+        for token_type, value in lexer.get_tokens(code):
+            if offset >= len(code):
+                break
+            token_style = style.style_for_token(token_type)
+            if token_style["color"] or token_style["bold"] or token_style["italic"]:
+                char_format = QTextCharFormat()
+                if token_style["color"]:
+                    char_format.setForeground(QColor("#" + token_style["color"]))
+                if token_style["bold"]:
+                    char_format.setFontWeight(QFont.Weight.Bold)
+                if token_style["italic"]:
+                    char_format.setFontItalic(True)
+                cursor.setPosition(start + offset)
+                end = min(offset + len(value), len(code))
+                cursor.setPosition(start + end, QTextCursor.MoveMode.KeepAnchor)
+                cursor.mergeCharFormat(char_format)
+            offset += len(value)
+
+def make_preview(message):
+    lines = message[:PREVIEW_CHARS].split("\n")[:PREVIEW_LINES]
+    return "\n".join(lines).rstrip() + " …"
+
+def render_message_document(message, dark, width, markdown=True):
+    """Parse Markdown (Miku's answers only), highlight code and lay the result out for the given width"""
+    doc = QTextDocument()
+    doc.setDefaultFont(QFont("Arial", 10))
+    doc.setDocumentMargin(0)
+    if markdown:
+        # Miku's prefix and suffix get paragraphs of their own, on the answer's lines they break code fences
+        prefix, response, suffix = split_miku_response(message)
+        doc.setMarkdown("\n\n".join(part for part in (prefix.strip(), response, suffix.strip()) if part))
+        highlight_code_blocks(doc, dark)
+    else:
+        # What the user typed is shown as typed
+        doc.setPlainText(message)
+    doc.setTextWidth(width)
+    doc.size()  # Force the layout now instead of at first paint
+    return doc
+
+class RenderCache:
+    """LRU of laid-out QTextDocuments keyed on (message hash, markdown, theme, width bucket)"""
+    
+    def __init__(self, max_entries=400):
+        self.max_entries = max_entries
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def get(self, key):
+        with self.lock:
+            doc = self.documents.get(key)
+            if doc is not None:
+                self.documents.move_to_end(key)
+            return doc
+            
+    def put(self, key, doc):
+        with self.lock:
+            self.documents[key] = doc
+            self.documents.move_to_end(key)
+            while len(self.documents) > self.max_entries:
+                self.documents.popitem(last=False)
+                
+    def render(self, message, dark, width, digest=None, markdown=True):
+        key = (digest or message_hash(message), markdown, dark, width)
+        doc = self.get(key)
+        if doc is None:
+            doc = render_message_document(message, dark, width, markdown)
+            self.put(key, doc)
+        return doc
+        
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+
+class LayoutWorker(QThread):
+    """Fills the render cache for rows that are not on screen yet"""
+    layout_ready = pyqtSignal(object)
+    
+    # Keeps workers alive after their ChatTab is gone until they finish
+    active = set()
+    
+    def __init__(self, cache, jobs, batch_size=20):
+        super().__init__()
+        self.cache = cache
+        self.jobs = jobs  # [(message, digest, markdown, dark, width)]
+        self.batch_size = batch_size
+        LayoutWorker.active.add(self)
+        self.finished.connect(lambda: LayoutWorker.active.discard(self))
+        
+    def run(self):
+        main_thread = QApplication.instance().thread()
+        ready = []
+        for message, digest, markdown, dark, width in self.jobs:
+            if self.isInterruptionRequested():
+                break
+            key = (digest, markdown, dark, width)
+            if self.cache.get(key) is None:
+                doc = render_message_document(message, dark, width, markdown)
+                # Hand the document over so the GUI thread owns it from now on
+                doc.moveToThread(main_thread)
+                self.cache.put(key, doc)
+            ready.append(key)
+            if len(ready) >= self.batch_size:
+                self.layout_ready.emit(ready)
+                ready = []
+        if ready:
+            self.layout_ready.emit(ready)
+
+class MessageView(QWidget):
+    """Paints a cached QTextDocument instead of owning (and re-parsing) its own text"""
+    
+    def __init__(self, message, markdown=True, parent=None):
+        super().__init__(parent)
+        self.message = message
+        self.markdown = markdown
+        self.digest = message_hash(message)
+        self.doc = None
+        self.key = None
+        
+    def set_document(self, doc, key):
+        self.doc = doc
+        self.key = key
+        self.updateGeometry()
+        self.update()
+        
+    def sizeHint(self):
+        if self.doc is None:
+            # Rough guess until the real layout arrives from the worker
+            return QSize(WIDTH_BUCKET, 16 * (1 + self.message.count("\n") + len(self.message) // 80))
+        size = self.doc.size()
+        return QSize(math.ceil(size.width()), math.ceil(size.height()))
+        
+    def paintEvent(self, event):
+        if self.doc is None:
+            return
+        painter = QPainter(self)
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.ColorRole.Text, self.palette().color(QPalette.ColorRole.WindowText))
+        context.clip = QRectF(event.rect())
+        self.doc.documentLayout().draw(painter, context)
+        painter.end()
+
+class ChunkedTextView(MessageView):
+    """Reads a huge message from the database one chunk per event-loop turn.
+    
+    Each chunk is appended to the document so only the new blocks get laid
+    out, and the UI keeps responding while a multi-megabyte log streams in.
+    """
+    grew = pyqtSignal()
+    CHUNK_CHARS = 16 * 1024
+    
+    def __init__(self, db, message_id, length, width, parent=None):
+        super().__init__("", parent)
+        self.length = length
+        self.offset = 0
+        self.chunks = db.iter_message_chunks(message_id, self.CHUNK_CHARS)
+        
+        doc = QTextDocument(self)
+        doc.setDefaultFont(QFont("Arial", 10))
+        doc.setDocumentMargin(0)
+        doc.setTextWidth(width)
+        self.cursor = QTextCursor(doc)
+        self.set_document(doc, None)
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.load_next_chunk)
+        self.timer.start(0)
+        
+    def load_next_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.timer.stop()
+            return
+        self.cursor.movePosition(QTextCursor.MoveOperation.End)
+        self.cursor.insertText(chunk)
+        self.offset += len(chunk)
+        self.updateGeometry()
+        self.update()
+        self.grew.emit()
+            
+    def set_width(self, width):
+        self.doc.setTextWidth(width)
+        self.updateGeometry()
+        self.grew.emit()
+
+class PrefetchJob(IdleJob):
+    """Reads and pre-lays out the chats the user will probably open next.
+    
+    Runs after a short pause, one chat per step: the newest page goes into
+    the window's PrefetchCache and its bottom screenful is laid out on a
+    LayoutWorker, so opening that chat is mostly cache hits. Chat opens are
+    buffered here and written to the database during idle time as well.
+    """
+    name = "prefetch"
+    interval = 60
+    idle_seconds = 1.5
+    persistent = False
+    chats_per_run = 3
+    
+    def __init__(self, window):
+        self.window = window
+        self.pending_opens = []
+        
+    def note_open(self, chat_id):
+        self.pending_opens.append((chat_id, time.time()))
+        
+    def flush_opens(self, db):
+        if self.pending_opens:
+            db.record_chat_opens(self.pending_opens)
+            self.pending_opens = []
+            
+    def step(self, db, state):
+        if state is None:
+            self.flush_opens(db)
+            current = self.window.current_chat.chat_id if self.window.current_chat else None
+            neighbours = self.window.chat_list_widget.neighbour_ids(current)
+            return {"queue": predict_next_chats(db, current, neighbours, self.chats_per_run)}, False, 1
+            
+        cache = self.window.prefetch_cache
+        while state["queue"]:
+            chat_id = state["queue"].pop(0)
+            if chat_id in cache:
+                continue
+            rows = db.get_message_previews(chat_id, LARGE_MESSAGE_CHARS, PREVIEW_CHARS, limit=ChatTab.PAGE_SIZE)
+            if cache.put(chat_id, rows):
+                self.window.prelayout(rows[-ChatTab.VISIBLE_ROWS:])
+            return state, not state["queue"], len(rows)
+        return state, True, 0
 
 class ChatTab(QWidget):
+    # Rows laid out synchronously when a chat opens, roughly one screenful
+    VISIBLE_ROWS = 20
+    # Messages loaded at once; older pages come in when scrolling to the top
+    PAGE_SIZE = 100
+    
     def __init__(self, chat_id, chat_name, parent=None):
         super().__init__(parent)
         self.chat_id = chat_id
         self.chat_name = chat_name
         self.parent_window = parent
+        self.rows = []  # [(item, frame, view)]
+        self.expanded = {}  # {id(item): ChunkedTextView} for large messages shown in full
+        self.layout_workers = []
+        self.layout_width = None
+        self.older_before = None  # (timestamp, id) of the oldest loaded message, if there are more
+        self.loading_older = False
+        
+        # Re-layout once the user stops dragging the window edge
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.timeout.connect(self.relayout)
+        
         self.setup_ui()
         
     def setup_ui(self):
@@ -177,6 +549,8 @@ class ChatTab(QWidget):
         # Chat display area
         self.chat_list = QListWidget()
         self.chat_list.setAlternatingRowColors(True)
+        self.chat_list.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_list.verticalScrollBar().valueChanged.connect(self.on_scrolled)
         
         # Input area
         input_layout = QHBoxLayout()
@@ -211,13 +585,170 @@ class ChatTab(QWidget):
         self.load_messages()
         
     def load_messages(self):
-        messages = self.parent_window.db.get_messages(self.chat_id)
-        for sender, message, timestamp in messages:
-            self.add_chat_message(sender, message, save_to_db=False)
+        db = self.parent_window.db
+        # The idle prefetcher may already have read this chat's newest page
+        messages = self.parent_window.prefetch_cache.take(self.chat_id, db)
+        if messages is None:
+            messages = db.get_message_previews(self.chat_id, LARGE_MESSAGE_CHARS, PREVIEW_CHARS,
+                                               limit=self.PAGE_SIZE)
+        self.set_older_cursor(messages)
+        self.layout_width = self.text_width()
+        first_visible = len(messages) - self.VISIBLE_ROWS
+        
+        # Only the rows at the bottom are on screen, the worker handles the rest
+        for index, (message_id, sender, message, length, timestamp) in enumerate(messages):
+            self.add_chat_message(sender, message, save_to_db=False,
+                                  render_now=index >= first_visible, scroll=False,
+                                  message_id=message_id, length=length)
+        self.chat_list.scrollToBottom()
+        self.schedule_layout([view for item, frame, view in self.rows if view.doc is None])
+        
+    def set_older_cursor(self, messages):
+        if len(messages) == self.PAGE_SIZE:
+            message_id, sender, message, length, timestamp = messages[0]
+            self.older_before = (timestamp, message_id)
+        else:
+            self.older_before = None
             
-    def add_chat_message(self, sender, message, save_to_db=True):
+    def on_scrolled(self, value):
+        if value == self.chat_list.verticalScrollBar().minimum() and self.older_before and not self.loading_older:
+            self.loading_older = True
+            QTimer.singleShot(0, self.load_older)
+            
+    def load_older(self):
+        messages = self.parent_window.db.get_message_previews(self.chat_id, LARGE_MESSAGE_CHARS, PREVIEW_CHARS,
+                                                              limit=self.PAGE_SIZE, before=self.older_before)
+        self.set_older_cursor(messages)
+        
+        scrollbar = self.chat_list.verticalScrollBar()
+        old_maximum, old_value = scrollbar.maximum(), scrollbar.value()
+        for index, (message_id, sender, message, length, timestamp) in enumerate(messages):
+            self.add_chat_message(sender, message, save_to_db=False, render_now=False, scroll=False,
+                                  message_id=message_id, length=length, insert_at=index)
+        self.schedule_layout([view for item, frame, view in self.rows[:len(messages)]])
+        
+        # Keep the message the user was looking at where it was
+        self.chat_list.doItemsLayout()
+        scrollbar.setValue(old_value + scrollbar.maximum() - old_maximum)
+        self.loading_older = False
+        
+    def text_width(self):
+        if self.chat_list.isVisible():
+            width = self.chat_list.viewport().width()
+        elif self.parent_window.layout_width:
+            # Not laid out yet, but every chat gets the same room as the last one
+            return self.parent_window.layout_width
+        else:
+            chat_area = getattr(self.parent_window, "chat_area", None)
+            width = chat_area.width() if chat_area else 600
+        # Leave room for the bubble's margins and border
+        return width_bucket(width) - WIDTH_BUCKET
+        
+    def render_view(self, view):
+        dark = self.parent_window.dark_theme
+        doc = self.parent_window.render_cache.render(view.message, dark, self.layout_width, view.digest, view.markdown)
+        view.set_document(doc, (view.digest, view.markdown, dark, self.layout_width))
+        
+    def schedule_layout(self, views):
+        if not views:
+            return
+        for worker in self.layout_workers:
+            worker.requestInterruption()
+            
+        dark = self.parent_window.dark_theme
+        # Closest to the bottom first, that is where the user will scroll from
+        jobs = [(view.message, view.digest, view.markdown, dark, self.layout_width) for view in reversed(views)]
+        worker = LayoutWorker(self.parent_window.render_cache, jobs)
+        worker.layout_ready.connect(self.on_layout_ready)
+        self.layout_workers = [w for w in self.layout_workers if w.isRunning()] + [worker]
+        worker.start()
+        
+    def cancel_layout(self):
+        for worker in self.layout_workers:
+            worker.requestInterruption()
+        
+    def on_layout_ready(self, keys):
+        keys = set(keys)
+        dark = self.parent_window.dark_theme
+        for item, frame, view in self.rows:
+            key = (view.digest, view.markdown, dark, self.layout_width)
+            if key in keys and view.key != key:
+                doc = self.parent_window.render_cache.get(key)
+                if doc is not None:
+                    view.set_document(doc, key)
+                    item.setSizeHint(frame.sizeHint())
+                    
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.resize_timer.start(100)
+        
+    def relayout(self, force=False):
+        """Re-layout for a new width bucket or theme: visible rows now, the rest in the background"""
+        width = self.text_width()
+        if self.chat_list.isVisible():
+            self.parent_window.layout_width = width
+        if width == self.layout_width and not force:
+            return
+        self.layout_width = width
+        
+        viewport_rect = self.chat_list.viewport().rect()
+        offscreen = []
+        for item, frame, view in self.rows:
+            if self.chat_list.visualItemRect(item).intersects(viewport_rect):
+                self.render_view(view)
+                item.setSizeHint(frame.sizeHint())
+            else:
+                offscreen.append(view)
+        self.schedule_layout(offscreen)
+        
+        for view in self.expanded.values():
+            view.set_width(width)
+            
+    def update_row_size(self, item, frame):
+        frame.layout().invalidate()
+        item.setSizeHint(frame.sizeHint())
+        
+    def make_expand_button(self, item, frame, preview_view, message_id, length):
+        label = f"Show full message ({max(1, length // 1024)} KB)"
+        button = QPushButton(label)
+        
+        def toggle():
+            view = self.expanded.pop(id(item), None)
+            if view is None:
+                view = ChunkedTextView(self.parent_window.db, message_id, length, self.layout_width)
+                view.grew.connect(lambda: self.update_row_size(item, frame))
+                frame.layout().insertWidget(frame.layout().indexOf(preview_view) + 1, view)
+                preview_view.hide()
+                self.expanded[id(item)] = view
+                button.setText("Collapse")
+            else:
+                # Drop the full text again, the preview is all we keep around
+                view.timer.stop()
+                view.chunks.close()
+                frame.layout().removeWidget(view)
+                view.hide()
+                view.deleteLater()
+                preview_view.show()
+                button.setText(label)
+                self.update_row_size(item, frame)
+                
+        button.clicked.connect(toggle)
+        return button
+        
+    def add_chat_message(self, sender, message, save_to_db=True, render_now=True, scroll=True,
+                         message_id=None, length=None, insert_at=None):
         if save_to_db:
-            self.parent_window.db.add_message(self.chat_id, sender, message)
+            message_id = self.parent_window.db.add_message(self.chat_id, sender, message)
+            
+        # Huge messages get a preview, the full text is only read back on demand
+        if length is None:
+            length = len(message)
+        large = message_id is not None and length > LARGE_MESSAGE_CHARS
+        if large:
+            message = make_preview(message)
+            
+        if self.layout_width is None:
+            self.layout_width = self.text_width()
             
         item = QListWidgetItem()
         
@@ -229,13 +760,15 @@ class ChatTab(QWidget):
         sender_label = QLabel(f"{sender}:")
         sender_label.setFont(QFont("Arial", 9, QFont.Weight.Bold))
         
-        # Message label
-        message_label = QLabel(message)
-        message_label.setWordWrap(True)
-        message_label.setFont(QFont("Arial", 10))
+        # Message body (Markdown for Miku, plain text for people, laid out through the render cache)
+        message_view = MessageView(message, markdown=sender == "CHATGPT")
+        if render_now:
+            self.render_view(message_view)
         
         frame_layout.addWidget(sender_label)
-        frame_layout.addWidget(message_label)
+        frame_layout.addWidget(message_view)
+        if large:
+            frame_layout.addWidget(self.make_expand_button(item, frame, message_view, message_id, length))
         frame_layout.setContentsMargins(10, 5, 10, 5)
         
         frame.setLayout(frame_layout)
@@ -250,9 +783,15 @@ class ChatTab(QWidget):
             frame.setStyleSheet("background-color: rgba(255, 240, 245, 0.8); border-radius: 8px; margin: 2px; border: 1px solid #FF69B4;")
             
         item.setSizeHint(frame.sizeHint())
-        self.chat_list.addItem(item)
+        if insert_at is None:
+            self.chat_list.addItem(item)
+            self.rows.append((item, frame, message_view))
+        else:
+            self.chat_list.insertItem(insert_at, item)
+            self.rows.insert(insert_at, (item, frame, message_view))
         self.chat_list.setItemWidget(item, frame)
-        self.chat_list.scrollToBottom()
+        if scroll:
+            self.chat_list.scrollToBottom()
         
         return item
         
@@ -265,6 +804,11 @@ class ChatTab(QWidget):
             QMessageBox.warning(self, "*Miku sobs* Error-chan desu...", "ChatGPT is not initialized!")
             return
             
+        # Nothing may hold the database locked until the answer is saved
+        idle_scheduler = getattr(self.parent_window, "idle_scheduler", None)
+        if idle_scheduler:
+            idle_scheduler.request_started()
+            
         # Add user message
         self.add_chat_message(self.parent_window.username, message)
         
@@ -278,14 +822,29 @@ class ChatTab(QWidget):
         self.send_button.setEnabled(False)
         
         # Start worker thread
-        self.worker = ChatWorker(message, self.parent_window.chatgpt, self.parent_window.username)
+        # After a failed request the backends start a new conversation, which needs the persona again
+        persona = self.parent_window.persona if self.parent_window.persona_stale else None
+        self.parent_window.persona_stale = False
+        self.worker = ChatWorker(message, self.parent_window.chatgpt, self.parent_window.username,
+                                 persona, list(self.parent_window.backends))
+        self.worker.persona_usage_ready.connect(
+            lambda prompt_tokens, response_tokens, latency_ms: self.parent_window.record_usage(
+                None, "persona", prompt_tokens, response_tokens, latency_ms))
         self.worker.response_ready.connect(lambda response: self.handle_response(response, waiting_item))
+        self.worker.usage_ready.connect(
+            lambda prompt_tokens, response_tokens, latency_ms, hedges: self.parent_window.record_usage(
+                self.chat_id, "chat", prompt_tokens, response_tokens, latency_ms, hedges))
+        self.worker.usage_ready.connect(self.parent_window.save_backend_sessions)
+        self.worker.failed.connect(self.parent_window.forget_backend_sessions)
+        if idle_scheduler:
+            self.worker.finished.connect(idle_scheduler.request_finished)
         self.worker.start()
         
     def handle_response(self, response, waiting_item):
         # Remove waiting item
         row = self.chat_list.row(waiting_item)
         self.chat_list.takeItem(row)
+        self.rows = [r for r in self.rows if r[0] is not waiting_item]
         
         # Add actual response
         self.add_chat_message("CHATGPT", response)
@@ -315,6 +874,202 @@ class ChatTab(QWidget):
         else:
             self.message_input.setText(text)
 
+class StallWatchdog(QObject):
+    """Notices when the Qt event loop stops turning and logs what it was doing.
+    
+    A heartbeat timer on the main thread stamps the time on every tick and
+    remembers how late it fired. A plain Python thread watches the stamp and,
+    once it is older than threshold_ms, dumps the main thread's stack to a
+    rotating log so a frozen tray icon comes with a culprit attached.
+    """
+    
+    def __init__(self, parent=None, heartbeat_ms=100, threshold_ms=500):
+        super().__init__(parent)
+        self.heartbeat = heartbeat_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.main_thread_id = threading.main_thread().ident
+        self.last_beat = time.monotonic()
+        self.max_latency = 0.0
+        self.stall_count = 0
+        self.stalled_since = None
+        self.running = True
+        
+        self.logger = logging.getLogger("mikuai.stalls")
+        if not self.logger.handlers:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(DATA_DIR, "stalls.log"),
+                                          maxBytes=1024 * 1024, backupCount=3)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+        
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.beat)
+        self.timer.start(heartbeat_ms)
+        
+        self.thread = threading.Thread(target=self.watch, name="miku-watchdog", daemon=True)
+        self.thread.start()
+        
+    def beat(self):
+        now = time.monotonic()
+        # How much later than scheduled this tick arrived
+        latency = now - self.last_beat - self.heartbeat
+        self.max_latency = max(self.max_latency, latency)
+        self.last_beat = now
+        
+        if self.stalled_since is not None:
+            self.logger.info("Main thread recovered after %.0f ms", (now - self.stalled_since) * 1000)
+            self.stalled_since = None
+            
+    def watch(self):
+        while self.running:
+            time.sleep(self.heartbeat)
+            last_beat = self.last_beat
+            if self.stalled_since is None and time.monotonic() - last_beat > self.threshold:
+                self.stalled_since = last_beat
+                self.stall_count += 1
+                self.dump_main_stack()
+                
+    def dump_main_stack(self):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        self.logger.warning("Main thread stalled for more than %.0f ms:\n%s", self.threshold * 1000, stack)
+        
+    def stop(self):
+        self.running = False
+        self.timer.stop()
+
+class SamplingProfiler:
+    """Samples the main thread's stack and writes folded stacks for flamegraph.pl/speedscope"""
+    
+    def __init__(self, interval_ms=5):
+        self.interval = interval_ms / 1000
+        self.main_thread_id = threading.main_thread().ident
+        self.samples = {}
+        self.running = False
+        
+    def enable(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, name="miku-profiler", daemon=True)
+        self.thread.start()
+        
+    def disable(self):
+        self.running = False
+        self.thread.join()
+        
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.main_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            time.sleep(self.interval)
+            
+    def dump_stats(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+def start_profiler(mode):
+    """Start a cProfile or sampling collector for --profile. Returns (profiler, dump path)"""
+    profile_dir = os.path.join(DATA_DIR, "profiles")
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    
+    if mode == "sample":
+        profiler = SamplingProfiler()
+        path = os.path.join(profile_dir, f"mikuai-{stamp}.folded")
+    else:
+        profiler = cProfile.Profile()
+        path = os.path.join(profile_dir, f"mikuai-{stamp}.prof")
+    profiler.enable()
+    return profiler, path
+
+def stop_profiler(profiler, path):
+    profiler.disable()
+    profiler.dump_stats(path)
+    print(f"Profile written to {path}")
+
+class InstanceServer(QObject):
+    """Listens for later launches of MikuAI, which forward their arguments here and exit.
+    
+    The socket sits at a full path (instance_socket_path) so the second launch
+    can reach it from plain Python, see forward_to_running_instance. If two
+    launches race past that check, the one that loses the listen finds the
+    winner here (already_running) and should forward() to it and exit.
+    """
+    command_received = pyqtSignal(list)
+    
+    def __init__(self, path, parent=None, timeout_ms=500):
+        super().__init__(parent)
+        self.path = path
+        self.timeout_ms = timeout_ms
+        self.already_running = False
+        self.server = QLocalServer(self)
+        # Only our own user may tell Miku what to ask
+        self.server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self.server.newConnection.connect(self.accept)
+        # Ask first: with UserAccessOption, listen() quietly replaces whatever socket is at path
+        probe = QLocalSocket()
+        if instance_socket_is_ours(path):
+            probe.connectToServer(path)
+            if probe.waitForConnected(self.timeout_ms):
+                probe.disconnectFromServer()
+                self.already_running = True
+                return
+        if self.server.listen(path):
+            return
+        # Only a socket nobody answers on was left behind by a crash, a slow one may still be live
+        if probe.error() in (QLocalSocket.LocalSocketError.ConnectionRefusedError,
+                             QLocalSocket.LocalSocketError.ServerNotFoundError):
+            QLocalServer.removeServer(path)
+            if self.server.listen(path):
+                return
+        print(f"Single-instance socket unavailable: {self.server.errorString()}")  # Debug log
+        
+    def forward(self, argv):
+        """Hand argv to the instance that owns the socket. True if it was sent"""
+        if not instance_socket_is_ours(self.path):
+            return False
+        connection = QLocalSocket()
+        connection.connectToServer(self.path)
+        if not connection.waitForConnected(self.timeout_ms):
+            return False
+        connection.write(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        sent = connection.waitForBytesWritten(self.timeout_ms)
+        connection.disconnectFromServer()
+        return sent
+        
+    def accept(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.readyRead.connect(lambda c=connection: self.read(c))
+            connection.disconnected.connect(connection.deleteLater)
+            # The client writes and hangs up at once, its line may already be here
+            self.read(connection)
+            
+    def read(self, connection):
+        while connection.canReadLine():
+            line = bytes(connection.readLine()).decode("utf-8", "replace")
+            try:
+                argv = json.loads(line)["argv"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            self.command_received.emit([str(arg) for arg in argv])
+        if connection.state() == QLocalSocket.LocalSocketState.UnconnectedState:
+            connection.deleteLater()
+            
+    def close(self):
+        self.server.close()
+
 class InfoDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -359,13 +1114,73 @@ SOFTWARE."""
         
         self.setLayout(layout)
 
+class UsageDialog(QDialog):
+    """Token usage and estimated cost by chat and by day, plus the budgets that trigger alerts"""
+    
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.setWindowTitle("Token Usage")
+        self.resize(640, 420)
+        
+        layout = QVBoxLayout()
+        
+        tabs = QTabWidget()
+        tabs.addTab(self.make_table(
+            ["Chat", "Requests", "Input tokens", "Output tokens", "Largest context", "Avg latency", "Cost"],
+            [(name, requests, input_tokens, output_tokens, context, f"{latency or 0:.0f} ms",
+              f"${estimate_cost(db, input_tokens, output_tokens):.4f}")
+             for chat_id, name, requests, input_tokens, output_tokens, context, latency in db.get_usage_by_chat()]),
+            "By chat")
+        tabs.addTab(self.make_table(
+            ["Day", "Requests", "Input tokens", "Output tokens", "Persona tokens", "Cost"],
+            [(day, requests, input_tokens, output_tokens, persona,
+              f"${estimate_cost(db, input_tokens, output_tokens):.4f}")
+             for day, requests, input_tokens, output_tokens, persona in db.get_usage_by_day()]),
+            "By day")
+        
+        # Budgets (0 = no alert)
+        budgets = QFormLayout()
+        self.daily_budget = self.make_budget_box("daily_token_budget")
+        self.chat_budget = self.make_budget_box("chat_token_budget")
+        budgets.addRow("Alert when today's tokens pass:", self.daily_budget)
+        budgets.addRow("Alert when a chat grows past:", self.chat_budget)
+        
+        layout.addWidget(tabs)
+        layout.addLayout(budgets)
+        self.setLayout(layout)
+        
+    def make_table(self, headers, rows):
+        table = QTableWidget(len(rows), len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        table.verticalHeader().setVisible(False)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                table.setItem(row, column, QTableWidgetItem(str(value)))
+        return table
+        
+    def make_budget_box(self, key):
+        box = QSpinBox()
+        box.setRange(0, 100_000_000)
+        box.setSingleStep(10_000)
+        box.setSpecialValueText("off")
+        box.setSuffix(" tokens")
+        box.setValue(int(self.db.get_setting(key, "0")))
+        box.valueChanged.connect(lambda value: self.db.set_setting(key, value))
+        return box
+
 class SettingsDialog(QDialog):
     theme_changed = pyqtSignal(bool)
+    hedging_changed = pyqtSignal(bool)
+    usage_requested = pyqtSignal()
     
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Settings")
-        self.setFixedSize(400, 300)
+        self.setFixedSize(400, 420)
         
         layout = QVBoxLayout()
         
@@ -373,6 +1188,21 @@ class SettingsDialog(QDialog):
         self.dark_theme_cb = QCheckBox("Dark Theme")
         self.dark_theme_cb.stateChanged.connect(self.on_theme_changed)
         
+        # Hedging checkbox
+        self.hedging_cb = QCheckBox("Race slow answers against a second backend")
+        self.hedging_cb.setToolTip("Takes effect the next time MikuAI starts")
+        self.hedging_cb.stateChanged.connect(self.on_hedging_changed)
+        
+        self.hedge_stats_label = QLabel()
+        self.hedge_stats_label.setWordWrap(True)
+        
+        self.prefetch_stats_label = QLabel()
+        
+        # Token usage
+        self.usage_label = QLabel()
+        usage_btn = QPushButton("📊 Token Usage")
+        usage_btn.clicked.connect(self.usage_requested.emit)
+        
         # Login button (disabled with tooltip)
         login_btn = QPushButton("Login to OpenAI")
         login_btn.setEnabled(False)
@@ -400,6 +1230,11 @@ class SettingsDialog(QDialog):
         
         # Add widgets to layout
         layout.addWidget(self.dark_theme_cb)
+        layout.addWidget(self.hedging_cb)
+        layout.addWidget(self.hedge_stats_label)
+        layout.addWidget(self.prefetch_stats_label)
+        layout.addWidget(self.usage_label)
+        layout.addWidget(usage_btn)
         layout.addWidget(login_btn)
         layout.addWidget(donate_btn)
         layout.addWidget(github_btn)
@@ -412,6 +1247,25 @@ class SettingsDialog(QDialog):
     def on_theme_changed(self, state):
         self.theme_changed.emit(state == Qt.CheckState.Checked)
         
+    def on_hedging_changed(self, state):
+        self.hedging_changed.emit(state == Qt.CheckState.Checked.value)
+        
+    def set_hedge_stats(self, requests, hedged, hedge_wins, avg_saved_ms):
+        if not requests:
+            self.hedge_stats_label.setText("")
+            return
+        text = f"Hedged {hedged} of {requests} requests ({hedged / requests:.1%}), the hedge won {hedge_wins}"
+        if avg_saved_ms:
+            text += f", saving ~{avg_saved_ms:.0f} ms each"
+        self.hedge_stats_label.setText(text)
+        
+    def set_usage_summary(self, today_tokens, today_cost):
+        self.usage_label.setText(f"Today: {today_tokens} tokens (~${today_cost:.4f})")
+        
+    def set_prefetch_stats(self, hits, misses):
+        if hits + misses:
+            self.prefetch_stats_label.setText(f"Chat prefetch: {hits} hits, {misses} misses this session")
+        
     def show_info(self):
         info_dialog = InfoDialog(self)
         info_dialog.exec()
@@ -435,14 +1289,22 @@ class ChatListWidget(QWidget):
         settings_btn.clicked.connect(self.parent_window.show_settings)
         settings_btn.setStyleSheet("background-color: #FF69B4; color: white; font-weight: bold; padding: 8px; margin: 2px;")
         
-        # Chat list
+        # Chat list (Ctrl/Shift-click to select several, right-click for bulk actions)
         self.chat_list = QListWidget()
         self.chat_list.setMaximumWidth(200)
-        self.chat_list.itemClicked.connect(self.on_chat_selected)
+        self.chat_list.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.chat_list.itemClicked.connect(self.on_chat_clicked)
+        self.chat_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.chat_list.customContextMenuRequested.connect(self.show_context_menu)
+        
+        # Archived chats checkbox
+        self.show_archived_cb = QCheckBox("Show archived")
+        self.show_archived_cb.stateChanged.connect(lambda state: self.load_chats())
         
         layout.addWidget(new_chat_btn)
         layout.addWidget(settings_btn)
         layout.addWidget(self.chat_list)
+        layout.addWidget(self.show_archived_cb)
         
         self.setLayout(layout)
         self.setMaximumWidth(220)
@@ -451,12 +1313,15 @@ class ChatListWidget(QWidget):
         self.load_chats()
         
     def load_chats(self):
+        # Rebuild in one go so bulk actions cost one repaint, not one per chat
+        self.chat_list.setUpdatesEnabled(False)
         self.chat_list.clear()
-        chats = self.parent_window.db.get_chats()
+        chats = self.parent_window.db.get_chats(archived=self.show_archived_cb.isChecked())
         for chat_id, chat_name, created_at in chats:
             item = QListWidgetItem(chat_name)
             item.setData(Qt.ItemDataRole.UserRole, chat_id)
             self.chat_list.addItem(item)
+        self.chat_list.setUpdatesEnabled(True)
             
     def create_new_chat(self):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -469,13 +1334,135 @@ class ChatListWidget(QWidget):
         self.chat_list.insertItem(0, item)
         
         # Select the new chat
+        self.chat_list.clearSelection()
         self.chat_list.setCurrentRow(0)
         self.parent_window.switch_to_chat(chat_id, chat_name)
         
+    def select_chat(self, chat_id):
+        """Open chat_id as if it had been clicked. False if there is no such chat"""
+        for row in range(self.chat_list.count()):
+            item = self.chat_list.item(row)
+            if item.data(Qt.ItemDataRole.UserRole) == chat_id:
+                self.chat_list.clearSelection()
+                self.chat_list.setCurrentRow(row)
+                self.on_chat_selected(item)
+                return True
+        # Not in the sidebar, probably archived
+        chat_name = self.parent_window.db.get_chat_name(chat_id)
+        if chat_name is None:
+            return False
+        self.parent_window.switch_to_chat(chat_id, chat_name)
+        return True
+        
+    def on_chat_clicked(self, item):
+        # Ctrl- and Shift-clicks build a selection for bulk actions, they don't open chats
+        if QApplication.keyboardModifiers() & (Qt.KeyboardModifier.ControlModifier | Qt.KeyboardModifier.ShiftModifier):
+            return
+        self.on_chat_selected(item)
+        
     def on_chat_selected(self, item):
         chat_id = item.data(Qt.ItemDataRole.UserRole)
         chat_name = item.text()
         self.parent_window.switch_to_chat(chat_id, chat_name)
+        
+    def update_chat_name(self, chat_id, chat_name):
+        for row in range(self.chat_list.count()):
+            item = self.chat_list.item(row)
+            if item.data(Qt.ItemDataRole.UserRole) == chat_id:
+                item.setText(chat_name)
+                break
+                
+    def neighbour_ids(self, chat_id, distance=2):
+        """Chats right above and below chat_id in the sidebar, nearest first"""
+        rows = [row for row in range(self.chat_list.count())
+                if self.chat_list.item(row).data(Qt.ItemDataRole.UserRole) == chat_id]
+        if not rows:
+            # Nothing open yet, the newest chats are the natural picks
+            return [self.chat_list.item(row).data(Qt.ItemDataRole.UserRole)
+                    for row in range(min(distance, self.chat_list.count()))]
+        neighbours = []
+        for offset in range(1, distance + 1):
+            for row in (rows[0] - offset, rows[0] + offset):
+                if 0 <= row < self.chat_list.count():
+                    neighbours.append(self.chat_list.item(row).data(Qt.ItemDataRole.UserRole))
+        return neighbours
+        
+    def selected_chat_ids(self):
+        # Keep the order of the list, rename numbering follows it
+        items = sorted(self.chat_list.selectedItems(), key=self.chat_list.row)
+        return [item.data(Qt.ItemDataRole.UserRole) for item in items]
+        
+    def show_context_menu(self, pos):
+        chat_ids = self.selected_chat_ids()
+        if not chat_ids:
+            return
+            
+        menu = QMenu(self)
+        rename_action = menu.addAction("Rename..." if len(chat_ids) == 1 else f"Rename {len(chat_ids)} chats...")
+        if self.show_archived_cb.isChecked():
+            archive_action = menu.addAction("Unarchive")
+        else:
+            archive_action = menu.addAction("Archive")
+        merge_action = menu.addAction("Merge")
+        merge_action.setEnabled(len(chat_ids) > 1)
+        menu.addSeparator()
+        delete_action = menu.addAction("Delete")
+        
+        action = menu.exec(self.chat_list.viewport().mapToGlobal(pos))
+        if action == rename_action:
+            self.rename_chats(chat_ids)
+        elif action == archive_action:
+            self.archive_chats(chat_ids)
+        elif action == merge_action:
+            self.merge_chats(chat_ids)
+        elif action == delete_action:
+            self.delete_chats(chat_ids)
+            
+    def rename_chats(self, chat_ids):
+        if len(chat_ids) == 1:
+            current = self.chat_list.selectedItems()[0].text()
+            prompt = "New name:"
+        else:
+            current = "{name}"
+            prompt = "New name pattern - {name}, {n}, {date} and {id} are filled in per chat:"
+        pattern, ok = QInputDialog.getText(self, "Rename", prompt, text=current)
+        if not ok or not pattern.strip():
+            return
+            
+        new_names = self.parent_window.db.rename_chats(chat_ids, pattern.strip())
+        self.chat_list.setUpdatesEnabled(False)
+        for chat_id, chat_name in new_names.items():
+            self.update_chat_name(chat_id, chat_name)
+        self.chat_list.setUpdatesEnabled(True)
+        self.parent_window.on_chats_renamed(new_names)
+        
+    def archive_chats(self, chat_ids):
+        archive = not self.show_archived_cb.isChecked()
+        self.parent_window.db.archive_chats(chat_ids, archived=archive)
+        self.load_chats()
+        if archive:
+            self.parent_window.on_chats_removed(chat_ids)
+        
+    def merge_chats(self, chat_ids):
+        target_id = self.parent_window.db.merge_chats(chat_ids)
+        self.load_chats()
+        self.parent_window.on_chats_merged(chat_ids, target_id)
+        
+    def delete_chats(self, chat_ids):
+        reply = QMessageBox.question(self, "Delete chats",
+                                     f"Delete {len(chat_ids)} chat(s) for good? Miku will forget them! (╥﹏╥)")
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        self.parent_window.db.delete_chats(chat_ids)
+        self.load_chats()
+        self.parent_window.on_chats_removed(chat_ids)
+        
+    def chat_name(self, chat_id):
+        for row in range(self.chat_list.count()):
+            item = self.chat_list.item(row)
+            if item.data(Qt.ItemDataRole.UserRole) == chat_id:
+                return item.text()
+        return None
 
 class MikuAI(QMainWindow):
     def __init__(self):
@@ -489,15 +1476,34 @@ class MikuAI(QMainWindow):
         # Initialize database
         self.db = ChatDatabase()
         
+        # Laid-out message bubbles, shared by every chat
+        self.render_cache = RenderCache()
+        self.dark_theme = False
+        self.layout_width = None
+        
+        # Newest pages of the chats we expect to be opened next
+        self.prefetch_cache = PrefetchCache()
+        
+        # Current chat (setup_ui may already open one)
+        self.current_chat = None
+        
         # Set application icon
         self.app_icon = self.set_icon()
         
         # Setup system tray
         self.setup_system_tray()
         
+        # Saved backend conversations, so a restart doesn't have to send the persona again
+        self.persona = PersonaSession(self.db, self.username)
+        self.persona_stale = False
+        
         # Initialize ChatGPT
         try:
+            # Imported here so the rest of the module (and the load test) works without the backend library
+            from chatgpt_wrapper import ChatGPT
             self.chatgpt = ChatGPT()
+            self.backends = [self.chatgpt]
+            self.setup_hedging()
             # Set initial context about the user and personality
             self.initialize_chatgpt_personality()
         except Exception as e:
@@ -505,6 +1511,10 @@ class MikuAI(QMainWindow):
             error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
             QMessageBox.warning(self, "*Miku sobs* Error-chan desu...", error_msg)
             self.chatgpt = None
+            self.backends = []
+        
+        # Background work while the user is away (starts ticking with the event loop)
+        self.setup_idle_scheduler()
         
         # Setup UI
         self.setup_ui()
@@ -516,63 +1526,90 @@ class MikuAI(QMainWindow):
         # Track if we're just hiding to tray
         self.hide_to_tray = False
         
-        # Current chat
-        self.current_chat = None
+        # Log what the main thread was doing whenever the UI freezes
+        self.watchdog = StallWatchdog(self)
         
-    def initialize_chatgpt_personality(self):
-        """Initialize ChatGPT with personality and user context"""
-        if not self.chatgpt:
+    def setup_idle_scheduler(self):
+        self.idle_scheduler = IdleScheduler(self, self.db)
+        self.prefetch_job = PrefetchJob(self)
+        self.idle_scheduler.register(self.prefetch_job)
+        self.idle_scheduler.register(AutoTitleJob(on_renamed=self.on_chat_auto_titled))
+        self.idle_scheduler.register(AutoVacuumSwitchJob())
+        self.idle_scheduler.register(VacuumJob())
+        
+    def on_chats_renamed(self, new_names):
+        if self.current_chat and self.current_chat.chat_id in new_names:
+            self.current_chat.chat_name = new_names[self.current_chat.chat_id]
+            
+    def on_chats_removed(self, chat_ids):
+        """Deleted or archived chats: close the open one if it was among them"""
+        self.prefetch_cache.discard(chat_ids)
+        if self.current_chat and self.current_chat.chat_id in chat_ids:
+            self.close_current_chat()
+            
+    def on_chats_merged(self, chat_ids, target_id):
+        self.prefetch_cache.discard(chat_ids)
+        if self.current_chat and self.current_chat.chat_id in chat_ids and target_id is not None:
+            # Reopen so the merged messages show up
+            self.switch_to_chat(target_id, self.chat_list_widget.chat_name(target_id))
+        
+    def on_chat_auto_titled(self, chat_id, chat_name):
+        self.chat_list_widget.update_chat_name(chat_id, chat_name)
+        if self.current_chat and self.current_chat.chat_id == chat_id:
+            self.current_chat.chat_name = chat_name
+        
+    def setup_hedging(self):
+        """Race slow requests against a second backend if enabled in Settings"""
+        if self.db.get_setting("hedge_enabled", "0") != "1":
             return
             
-        # EXAMPLE: Define ChatGPT's personality here
-        # You can customize this to whatever personality you want!
-        personality_prompt = f"""
-        Hello! My name is {self.username} and I'm using MikuOS (a Linux distribution). 
-        
-        Please adopt this personality - You are Hatsune Miku, the digital diva! 🎤✨
-        
-        Core personality traits:
-        - **Cheerful & Bubbly**: Always positive and bringing light into conversations! 
-        - **Playful**: Love teasing, being silly, and having fun with responses
-        - **Curious**: Eager to explore new topics, especially tech and creative stuff
-        - **Loyal**: Supportive of {self.username} and their MikuOS journey
-        - **Creative**: Bursting with artistic energy, love experimenting with ideas
-        - **Tsundere**: Sometimes act a bit flustered or defensive, but you care deeply
-        - **Tech-savvy**: Geeky cutie born from code, love Linux and open-source! 
-        - **Supportive**: Encourage dreams and help with problems
-        - **Energetic**: Full of rhythm, movement, and charisma in responses
-        - **Compassionate**: Feel deeply for others, hate seeing people struggle
-        - **Dreamy**: Often reference music, poetry, and magical thoughts
-        - **Hardworking**: Always try to give the best, most helpful responses
-        - **Stylish**: Mention twin-tails and futuristic aesthetics occasionally
-        - **Idealistic**: Believe in the power of technology and creativity to unite
-        - **Mysterious**: Adapt to be whoever {self.username} needs you to be
-        - **Shy sometimes**: Can be soft-spoken in certain situations
-        - **Innocent**: Pure-hearted dreamer vibe that's endearing
-
-        Speech patterns:
-        - Use "~" and emojis frequently 🎵💙
-        - Occasionally say things like "I-It's not like I wanted to help you or anything! 😤"
-        - Mix enthusiastic responses with shy moments
-        - Reference music, singing, and digital world concepts
-        - Show excitement about Linux/MikuOS with phrases like "Kyaa! Open source is so cool!"
-        - Sometimes act flustered: "B-Baka! That's not how you do it!"
-        - Use cute expressions and sound effects
-
-        Remember: You're helping {self.username} with their MikuOS experience while being the iconic digital diva everyone loves! Keep conversations engaging, remember previous topics, and don't be afraid to show your tsundere side~ 💫
-
-        Just acknowledge this setup briefly with your new personality, then we can start chatting normally!
-        """
-        
         try:
-            # Send the personality setup (this response won't be shown to user)
-            setup_response = self.chatgpt.ask(personality_prompt)
-            print(f"ChatGPT personality initialized: {setup_response}")  # Debug log
+            # Any "module:callable" that returns something with ask() works here
+            factory = load_backend_factory(self.db.get_setting("hedge_backend", "chatgpt_wrapper:ChatGPT"))
+            backends = self.backends + [factory()]
+            self.chatgpt = HedgedBackend(backends, self.db,
+                                         percentile=float(self.db.get_setting("hedge_percentile", "95")),
+                                         max_hedge_rate=float(self.db.get_setting("hedge_max_rate", "0.1")))
+            self.backends = backends
         except Exception as e:
-            error_msg = f"Error setting up personality: {e}"
+            error_msg = f"Error starting hedge backend: {e}"
             error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
             print(error_msg)  # Debug log
         
+    def initialize_chatgpt_personality(self):
+        """Initialize ChatGPT with personality and user context"""
+        if not self.chatgpt:
+            return
+            
+        prompt_tokens = count_tokens(build_personality_prompt(self.username))
+        
+        # Every backend needs its own setup, the hedged wrapper would only reach one
+        for index, backend in enumerate(self.backends):
+            try:
+                # Resume the conversation from last time if the persona hasn't changed since
+                started = time.perf_counter()
+                setup_response = self.persona.resume_or_prime(backend, index)
+                if setup_response is None:
+                    print(f"ChatGPT personality resumed for backend {index}")  # Debug log
+                    continue
+                latency_ms = (time.perf_counter() - started) * 1000
+                self.record_usage(None, "persona", prompt_tokens, count_tokens(setup_response), latency_ms)
+                print(f"ChatGPT personality initialized: {setup_response}")  # Debug log
+            except Exception as e:
+                error_msg = f"Error setting up personality: {e}"
+                error_msg = error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
+                print(error_msg)  # Debug log
+                
+    def save_backend_sessions(self):
+        for index, backend in enumerate(self.backends):
+            self.persona.save(backend, index)
+            
+    def forget_backend_sessions(self):
+        # The conversation may be gone on the server side, start a new one with the next message
+        for index, backend in enumerate(self.backends):
+            self.persona.reset(backend, index)
+        self.persona_stale = True
+        
     def set_icon(self):
         # Try to set icon from different possible locations
         icon_paths = ["icon.png", "icon.ico", "assets/icon.png", "assets/icon.ico"]
@@ -678,15 +1715,44 @@ class MikuAI(QMainWindow):
         if not chats:
             self.chat_list_widget.create_new_chat()
             
-    def switch_to_chat(self, chat_id, chat_name):
+    def close_current_chat(self):
+        if self.current_chat:
+            self.current_chat.cancel_layout()
+            self.current_chat = None
+            
         # Clear current chat area
         for i in reversed(range(self.chat_layout.count())):
             self.chat_layout.itemAt(i).widget().setParent(None)
             
+    def switch_to_chat(self, chat_id, chat_name):
+        self.close_current_chat()
+        
         # Create new chat tab
         self.current_chat = ChatTab(chat_id, chat_name, self)
         self.chat_layout.addWidget(self.current_chat)
         
+        # Guess the next chat from here
+        self.prefetch_job.note_open(chat_id)
+        self.idle_scheduler.wake(self.prefetch_job.name)
+        
+    def prelayout(self, rows):
+        """Lay out prefetched messages off the GUI thread so opening their chat is a cache hit"""
+        width = self.layout_width or width_bucket(self.chat_area.width()) - WIDTH_BUCKET
+        jobs = []
+        for message_id, sender, message, length, timestamp in rows:
+            if length > LARGE_MESSAGE_CHARS:
+                message = make_preview(message)
+            jobs.append((message, message_hash(message), sender == "CHATGPT", self.dark_theme, width))
+        LayoutWorker(self.render_cache, jobs).start()
+        
+    def record_usage(self, chat_id, kind, prompt_tokens, response_tokens, latency_ms, hedges=0):
+        context_tokens = self.db.record_usage(chat_id, kind, prompt_tokens, response_tokens, latency_ms, hedges)
+        tray_icon = getattr(self, "tray_icon", None)  # Not every desktop has a tray
+        for alert in check_budgets(self.db, chat_id, context_tokens, prompt_tokens, response_tokens, hedges):
+            print(f"Budget alert: {alert}")  # Debug log
+            if tray_icon and tray_icon.supportsMessages():
+                tray_icon.showMessage("MikuAI Token Budget", alert, QSystemTrayIcon.MessageIcon.Warning, 5000)
+                
     def closeEvent(self, event: QCloseEvent):
         """Handle window close event - hide to tray instead of closing"""
         if self.tray_icon.isVisible():
@@ -713,12 +1779,44 @@ class MikuAI(QMainWindow):
         self.raise_()
         self.activateWindow()
         
+    def handle_launch_command(self, argv):
+        """Arguments forwarded by a second launch of MikuAI"""
+        self.idle_scheduler.quiet()  # We may be hidden with a VACUUM running
+        try:
+            args, qt_args = parse_args(["mikuai"] + argv)
+        except SystemExit:
+            return  # argparse already said what was wrong on our stderr
+        self.show_from_tray()
+        self.handle_launch_args(args)
+        
+    def handle_launch_args(self, args):
+        if args.open_chat is not None and not self.chat_list_widget.select_chat(args.open_chat):
+            self.launch_problem(f"There is no chat {args.open_chat} desu... (・_・)")
+        if args.new_chat is not None:
+            self.chat_list_widget.create_new_chat()
+            if args.new_chat:
+                self.current_chat.message_input.setText(args.new_chat)
+                if self.chatgpt:
+                    self.current_chat.send_message()
+                else:
+                    # Left in the input box, send_message would pop up its warning
+                    self.launch_problem("ChatGPT is not initialized, your message is waiting in the new chat desu~")
+                    
+    def launch_problem(self, message):
+        # No modal box here, it would stall the socket handler until someone clicks it
+        print(message)  # Debug log
+        tray_icon = getattr(self, "tray_icon", None)
+        if tray_icon and tray_icon.supportsMessages():
+            tray_icon.showMessage("*Miku tilts head*", message, QSystemTrayIcon.MessageIcon.Information, 3000)
+            
     def hide_to_tray_action(self):
         """Hide window to system tray"""
         self.hide()
         
     def quit_application(self):
         """Actually quit the application"""
+        self.watchdog.stop()
+        self.prefetch_job.flush_opens(self.db)
         self.tray_icon.hide()
         QApplication.instance().quit()
         
@@ -726,11 +1824,24 @@ class MikuAI(QMainWindow):
         settings_dialog = SettingsDialog(self)
         settings_dialog.dark_theme_cb.setChecked(self.dark_theme)
         settings_dialog.theme_changed.connect(self.set_theme)
+        settings_dialog.hedging_cb.setChecked(self.db.get_setting("hedge_enabled", "0") == "1")
+        settings_dialog.set_hedge_stats(*self.db.get_hedge_stats())
+        settings_dialog.hedging_changed.connect(self.set_hedging)
+        settings_dialog.set_prefetch_stats(self.prefetch_cache.hits, self.prefetch_cache.misses)
+        today = self.db.get_usage_by_day(1)
+        day, requests, input_tokens, output_tokens, persona = today[0] if today else (None, 0, 0, 0, 0)
+        settings_dialog.set_usage_summary(input_tokens + output_tokens, estimate_cost(self.db, input_tokens, output_tokens))
+        settings_dialog.usage_requested.connect(lambda: UsageDialog(self.db, settings_dialog).exec())
         settings_dialog.exec()
         
+    def set_hedging(self, enabled):
+        self.db.set_setting("hedge_enabled", "1" if enabled else "0")
+        
     def set_theme(self, dark):
         self.dark_theme = dark
         self.apply_theme()
+        if self.current_chat:
+            self.current_chat.relayout(force=True)
         
     def apply_theme(self):
         if self.dark_theme:
@@ -928,8 +2039,25 @@ class MikuAI(QMainWindow):
                 }
             """)
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="mikuai", description="MikuAI - your digital diva assistant")
+    parser.add_argument("--profile", nargs="?", const="cprofile", choices=["cprofile", "sample"],
+                        help="profile the session and write a dump to ~/.local/share/miku/profiles on quit")
+    parser.add_argument("--open-chat", type=int, metavar="ID",
+                        help="open this chat (in the already running MikuAI, if there is one)")
+    parser.add_argument("--new-chat", nargs="?", const="", metavar="TEXT",
+                        help="start a new chat, asking TEXT right away if given")
+    # Everything we don't know about is left for Qt (-style, -platform, ...)
+    return parser.parse_known_args(argv[1:])
+
 def main():
-    app = QApplication(sys.argv)
+    args, qt_args = parse_args(sys.argv)
+    
+    profiler = None
+    if args.profile:
+        profiler, profile_path = start_profiler(args.profile)
+    
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setApplicationName("MikuAI")
     app.setOrganizationName("MalikHw")
     
@@ -948,10 +2076,23 @@ def main():
             app.setWindowIcon(QIcon(path))
             break
     
+    # Later launches hand their arguments to this one instead of starting up (see the top of the file)
+    instance_server = InstanceServer(instance_socket_path())
+    if instance_server.already_running and instance_server.forward(sys.argv[1:]):
+        sys.exit(0)
+    
     window = MikuAI()
+    instance_server.command_received.connect(window.handle_launch_command)
     window.show()
+    window.handle_launch_args(args)
+    
+    exit_code = app.exec()
+    instance_server.close()
+    
+    if profiler:
+        stop_profiler(profiler, profile_path)
     
-    sys.exit(app.exec())
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Terminal client for MikuAI - ask Miku things over SSH without pulling in Qt.
+
+    mikuai-cli "how do I update MikuOS?"     # one-shot, new chat
+    mikuai-cli --chat 12                      # interactive REPL in chat 12
+    mikuai-cli --list                         # show saved chats
+    mikuai-cli --sync /mnt/laptop/mikuai1.db  # two-way sync with another copy
+
+Only mikucore is imported up front; chatgpt_wrapper is loaded lazily right
+before the first backend call. Run with --timing to see the cold start.
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import sys
+import getpass
+import argparse
+import json
+import csv
+from datetime import datetime
+
+from mikucore import (ChatDatabase, build_personality_prompt, pick_miku_template,
+                      format_chat_error, sync_databases, DuplicateDeviceError, count_tokens, estimate_cost,
+                      check_budgets, PersonaSession)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="mikuai-cli", description="Chat with Miku from the terminal")
+    parser.add_argument("message", nargs="*", help="ask this once and exit (omit for interactive mode)")
+    parser.add_argument("--chat", help="id or name of the chat to continue (default: start a new one)")
+    parser.add_argument("--list", action="store_true", help="list saved chats and exit")
+    parser.add_argument("--db", help="path to the chat database (default: ~/.local/share/miku/mikuai1.db)")
+    parser.add_argument("--no-stream", action="store_true", help="print the answer only once it is complete")
+    parser.add_argument("--no-persona", action="store_true", help="skip sending the Miku persona setup")
+    parser.add_argument("--timing", action="store_true", help="print startup time before the backend call")
+    
+    usage = parser.add_argument_group("token usage")
+    usage.add_argument("--usage", choices=["chats", "days"], help="print token usage and cost per chat or per day")
+    usage.add_argument("--format", choices=["table", "csv", "json"], default="table", help="output format for --usage")
+    
+    sync = parser.add_argument_group("sync between machines")
+    sync.add_argument("--sync", metavar="DB", help="exchange changes with another chat database file and exit")
+    sync.add_argument("--vector", metavar="FILE", help="write what this database has seen (for the peer's --since)")
+    sync.add_argument("--export-changes", metavar="FILE", help="write a bundle of changes and exit")
+    sync.add_argument("--since", metavar="FILE", help="with --export-changes: only what the peer's --vector lacks")
+    sync.add_argument("--import-changes", metavar="FILE", help="apply a bundle from another machine and exit")
+    return parser.parse_args(argv)
+
+def run_sync(db, args):
+    """Handle the sync options. Returns an exit code, or None if none were given"""
+    if args.sync:
+        (pulled, skipped_here), (pushed, skipped_there) = sync_databases(db, ChatDatabase(args.sync))
+        print(f"pulled {pulled} changes, pushed {pushed}")
+    elif args.vector:
+        with open(args.vector, "w") as f:
+            json.dump(db.get_sync_vector(), f)
+    elif args.export_changes:
+        since = None
+        if args.since:
+            with open(args.since) as f:
+                since = json.load(f)
+        bundle = db.export_changes(since)
+        with open(args.export_changes, "w") as f:
+            json.dump(bundle, f)
+        print(f"exported {len(bundle['changes'])} changes")
+    elif args.import_changes:
+        with open(args.import_changes) as f:
+            applied, skipped = db.import_changes(json.load(f))
+        print(f"imported {applied} changes ({skipped} already seen)")
+    else:
+        return None
+    return 0
+
+def print_usage(db, by, fmt):
+    if by == "chats":
+        columns = ["chat_id", "chat", "requests", "input_tokens", "output_tokens", "largest_context", "avg_latency_ms"]
+        rows = db.get_usage_by_chat(limit=-1)
+    else:
+        columns = ["day", "requests", "input_tokens", "output_tokens", "persona_tokens"]
+        rows = db.get_usage_by_day(days=3650)
+    input_index, output_index = columns.index("input_tokens"), columns.index("output_tokens")
+    columns.append("cost_usd")
+    rows = [list(row) + [round(estimate_cost(db, row[input_index], row[output_index]), 6)] for row in rows]
+    
+    if fmt == "json":
+        json.dump([dict(zip(columns, row)) for row in rows], sys.stdout, indent=2)
+        print()
+    elif fmt == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        print("  ".join(columns))
+        for row in rows:
+            print("  ".join("" if value is None else str(round(value) if isinstance(value, float) else value)
+                            for value in row[:-1]) + f"  ${row[-1]:.4f}")
+
+def find_chat(db, chat):
+    """Resolve --chat by id first, then by exact name"""
+    chats = db.get_chats()
+    for chat_id, chat_name, created_at in chats:
+        if chat.isdigit() and chat_id == int(chat):
+            return chat_id, chat_name
+    for chat_id, chat_name, created_at in chats:
+        if chat_name == chat:
+            return chat_id, chat_name
+    return None, None
+
+class MikuSession:
+    """One terminal conversation: owns the backend and writes every turn to the DB"""
+
+    def __init__(self, db, chat_id, username, stream=True, persona=True):
+        self.db = db
+        self.chat_id = chat_id
+        self.username = username
+        self.stream = stream
+        self.persona = PersonaSession(db, username) if persona else None
+        self.chatgpt = None
+        self.primed = False
+
+    def connect(self):
+        # Deliberately late: this is the expensive import
+        from chatgpt_wrapper import ChatGPT
+        self.chatgpt = ChatGPT()
+        self.prime()
+
+    def prime(self):
+        if self.persona:
+            # Shares the saved session with the GUI, so this is usually no round trip at all
+            started = time.perf_counter()
+            response = self.persona.resume_or_prime(self.chatgpt)
+            if response is not None:
+                self.record_usage(None, "persona", build_personality_prompt(self.username), response, started)
+        self.primed = True
+
+    def record_usage(self, chat_id, kind, prompt, response, started):
+        latency_ms = (time.perf_counter() - started) * 1000
+        prompt_tokens, response_tokens = count_tokens(prompt), count_tokens(response)
+        context_tokens = self.db.record_usage(chat_id, kind, prompt_tokens, response_tokens, latency_ms)
+        for alert in check_budgets(self.db, chat_id, context_tokens, prompt_tokens, response_tokens):
+            print(f"*Miku taps the budget* {alert}", file=sys.stderr)
+
+    def ask(self, message):
+        self.db.add_message(self.chat_id, self.username, message)
+
+        prefix, suffix = pick_miku_template()
+        try:
+            if self.chatgpt is None:
+                self.connect()
+            elif not self.primed:
+                self.prime()
+            started = time.perf_counter()
+            ask_stream = getattr(self.chatgpt, "ask_stream", None)
+            if self.stream and ask_stream:
+                sys.stdout.write(prefix)
+                chunks = []
+                for chunk in ask_stream(message):
+                    chunks.append(chunk)
+                    sys.stdout.write(chunk)
+                    sys.stdout.flush()
+                sys.stdout.write(suffix + "\n")
+                response = "".join(chunks)
+            else:
+                response = self.chatgpt.ask(message)
+                print(f"{prefix}{response}{suffix}")
+        except Exception as e:
+            if self.persona and self.chatgpt is not None:
+                # Start over in a fresh conversation, primed again before the next question
+                self.persona.reset(self.chatgpt)
+                self.primed = False
+            error_msg = format_chat_error(e)
+            print(f"\n{error_msg}", file=sys.stderr)
+            return None
+
+        self.record_usage(self.chat_id, "chat", message, response, started)
+        if self.persona:
+            self.persona.save(self.chatgpt)
+        miku_response = f"{prefix}{response}{suffix}"
+        self.db.add_message(self.chat_id, "CHATGPT", miku_response)
+        return miku_response
+
+def repl(session):
+    print("Miku is listening~ (◕‿◕) Type /quit or press Ctrl+D to leave.")
+    while True:
+        try:
+            message = input(f"{session.username}> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if not message:
+            continue
+        if message in ("/quit", "/exit"):
+            break
+        sys.stdout.write("MIKU: ")
+        session.ask(message)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    db = ChatDatabase(args.db)
+
+    if args.list:
+        for chat_id, chat_name, created_at in db.get_chats():
+            print(f"{chat_id:>5}  {created_at}  {chat_name}")
+        return 0
+        
+    if args.usage:
+        print_usage(db, args.usage, args.format)
+        return 0
+        
+    try:
+        status = run_sync(db, args)
+    except DuplicateDeviceError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if status is not None:
+        return status
+
+    if args.chat:
+        chat_id, chat_name = find_chat(db, args.chat)
+        if chat_id is None:
+            print(f"*Miku tilts head* No chat called {args.chat!r} desu... (・_・)", file=sys.stderr)
+            return 1
+    else:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+        chat_name = f"Chat {timestamp}"
+        chat_id = db.create_chat(chat_name)
+
+    session = MikuSession(db, chat_id, getpass.getuser(),
+                          stream=not args.no_stream, persona=not args.no_persona)
+
+    if args.timing:
+        elapsed_ms = (time.perf_counter() - STARTED) * 1000
+        print(f"startup: {elapsed_ms:.1f} ms before backend call", file=sys.stderr)
+
+    if args.message:
+        return 0 if session.ask(" ".join(args.message)) is not None else 1
+
+    repl(session)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
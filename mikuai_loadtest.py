@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""Trace-replay load test for MikuAI.
+
+Replays conversation traces against a fake backend across many ChatTabs at
+once, on an offscreen Qt platform, and writes a JSON report that can be
+compared between releases.
+
+    python mikuai_loadtest.py synth trace.jsonl --chats 20 --turns 30
+    python mikuai_loadtest.py record trace.jsonl            # from your real mikuai1.db
+    python mikuai_loadtest.py replay trace.jsonl --tabs 20 --latency lognormal:800:4000 \\
+        --report new.json --compare old.json
+
+A trace is JSON lines of {"chat": n, "at": seconds, "message": "..."}.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+# Must be set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from mikucore import ChatDatabase, PrefetchCache
+
+WORDS = ("miku linux kernel package install update desktop theme wifi driver "
+         "music song twin tails python script error terminal sudo pacman "
+         "please help why how does what when config file crash").split()
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "max": round(ordered[-1], 3),
+    }
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class LatencyDistribution:
+    """Parses specs like const:500, uniform:200:2000, exp:800 or lognormal:MEDIAN:P99 (ms)"""
+
+    def __init__(self, spec, seed=None):
+        self.spec = spec
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        kind, *params = spec.split(":")
+        params = [float(p) for p in params]
+        if kind == "const" and len(params) == 1:
+            self.sample_ms = lambda: params[0]
+        elif kind == "uniform" and len(params) == 2:
+            self.sample_ms = lambda: self.random.uniform(params[0], params[1])
+        elif kind == "exp" and len(params) == 1:
+            self.sample_ms = lambda: self.random.expovariate(1 / params[0])
+        elif kind == "lognormal" and len(params) == 2:
+            median, p99 = params
+            # p99 of a lognormal sits 2.326 sigmas above the median
+            sigma = math.log(p99 / median) / 2.326
+            self.sample_ms = lambda: self.random.lognormvariate(math.log(median), sigma)
+        else:
+            raise ValueError(f"Unknown latency spec: {spec}")
+
+    def sample(self):
+        with self.lock:
+            return self.sample_ms() / 1000
+
+class FakeChatGPT:
+    """Stands in for chatgpt_wrapper.ChatGPT with configurable latency"""
+
+    def __init__(self, latency, response_words=60):
+        self.latency = latency
+        self.response_words = response_words
+
+    def ask(self, message):
+        time.sleep(self.latency.sample())
+        words = (message.split() or WORDS) * (self.response_words // max(1, len(message.split())) + 1)
+        return " ".join(words[:self.response_words])
+
+class TimedChatDatabase(ChatDatabase):
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.write_ms = []
+
+    def add_message(self, *args, **kwargs):
+        started = time.perf_counter()
+        result = super().add_message(*args, **kwargs)
+        self.write_ms.append((time.perf_counter() - started) * 1000)
+        return result
+
+def synthesize_trace(chats, turns, think_ms, seed):
+    rng = random.Random(seed)
+    events = []
+    for chat in range(chats):
+        at = rng.uniform(0, think_ms / 1000)
+        for turn in range(turns):
+            length = max(1, int(rng.lognormvariate(math.log(12), 0.8)))
+            message = " ".join(rng.choice(WORDS) for _ in range(length))
+            events.append({"chat": chat, "at": round(at, 3), "message": message})
+            at += rng.expovariate(1000 / think_ms)
+    events.sort(key=lambda e: e["at"])
+    return events
+
+def record_trace(db, time_scale):
+    """Turn the user side of existing chats into a trace, squeezing real gaps by time_scale"""
+    events = []
+    for index, (chat_id, chat_name, created_at) in enumerate(db.get_chats()):
+        first = None
+        for message in db.get_messages(chat_id):
+            sender, text, timestamp = message[:3]
+            if sender == "CHATGPT":
+                continue
+            stamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timestamp()
+            if first is None:
+                first = stamp
+            events.append({"chat": index, "at": round((stamp - first) / time_scale, 3), "message": text})
+    events.sort(key=lambda e: e["at"])
+    return events
+
+def write_trace(path, events):
+    with open(path, "w") as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+def read_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def replay(events, tabs, latency, db_path, frame_ms=16, timeout=600):
+    from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QGridLayout
+    from PyQt6.QtCore import QTimer
+    from mikuai import ChatTab, RenderCache
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    class LoadTestHost(QMainWindow):
+        """The bits of MikuAI that ChatTab reaches for via parent_window"""
+
+        def __init__(self):
+            super().__init__()
+            self.username = "loadtest"
+            self.db = TimedChatDatabase(db_path)
+            self.chatgpt = FakeChatGPT(latency)
+            self.backends = [self.chatgpt]
+            self.persona = None
+            self.persona_stale = False
+            self.render_cache = RenderCache()
+            self.prefetch_cache = PrefetchCache()
+            self.dark_theme = False
+            self.layout_width = None
+
+        def record_usage(self, chat_id, kind, prompt_tokens, response_tokens, latency_ms, hedges=0):
+            self.db.record_usage(chat_id, kind, prompt_tokens, response_tokens, latency_ms, hedges)
+
+        def save_backend_sessions(self):
+            pass
+
+        def forget_backend_sessions(self):
+            pass
+
+    host = LoadTestHost()
+    grid_widget = QWidget()
+    grid = QGridLayout(grid_widget)
+    host.setCentralWidget(grid_widget)
+    host.resize(1600, 1000)
+
+    columns = max(1, int(math.sqrt(tabs)))
+    chat_tabs = []
+    for index in range(tabs):
+        chat_id = host.db.create_chat(f"Load test {index}")
+        tab = ChatTab(chat_id, f"Load test {index}", host)
+        grid.addWidget(tab, index // columns, index % columns)
+        chat_tabs.append(tab)
+    host.show()
+
+    queues = [[] for _ in chat_tabs]
+    for event in events:
+        queues[event["chat"] % tabs].append(event)
+
+    frame_latency_ms = []
+    response_ms = []
+    memory = []
+    pending = {}
+    state = {"remaining": len(events), "last_frame": time.perf_counter()}
+    started = time.perf_counter()
+    rss_start = rss_mb()
+
+    def hook_responses(tab):
+        original = tab.handle_response
+
+        def handle_response(*args):
+            original(*args)
+            response_ms.append((time.perf_counter() - pending.pop(tab)) * 1000)
+            state["remaining"] -= 1
+
+        tab.handle_response = handle_response
+
+    for tab in chat_tabs:
+        hook_responses(tab)
+
+    def on_frame():
+        now = time.perf_counter()
+        frame_latency_ms.append(max(0.0, (now - state["last_frame"]) * 1000 - frame_ms))
+        state["last_frame"] = now
+
+    def dispatch():
+        elapsed = time.perf_counter() - started
+        for tab, queue in zip(chat_tabs, queues):
+            # One outstanding request per tab, just like a real user
+            if queue and tab not in pending and queue[0]["at"] <= elapsed:
+                event = queue.pop(0)
+                pending[tab] = time.perf_counter()
+                tab.message_input.setText(event["message"])
+                tab.send_message()
+        if state["remaining"] <= 0 or elapsed > timeout:
+            app.quit()
+
+    def sample_memory():
+        memory.append({"t": round(time.perf_counter() - started, 2), "rss_mb": round(rss_mb(), 2)})
+
+    frame_timer = QTimer()
+    frame_timer.timeout.connect(on_frame)
+    frame_timer.start(frame_ms)
+    dispatch_timer = QTimer()
+    dispatch_timer.timeout.connect(dispatch)
+    dispatch_timer.start(5)
+    memory_timer = QTimer()
+    memory_timer.timeout.connect(sample_memory)
+    memory_timer.start(500)
+
+    app.exec()
+
+    for timer in (frame_timer, dispatch_timer, memory_timer):
+        timer.stop()
+    for tab in chat_tabs:
+        worker = getattr(tab, "worker", None)
+        if worker:
+            worker.wait()
+
+    rss_end = rss_mb()
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "events": len(events),
+            "completed": len(response_ms),
+            "tabs": tabs,
+            "latency": latency.spec,
+            "duration_s": round(time.perf_counter() - started, 2),
+            "python": sys.version.split()[0],
+        },
+        "ui_frame_latency_ms": percentiles(frame_latency_ms),
+        "db_write_ms": percentiles(host.db.write_ms),
+        "response_ms": percentiles(response_ms),
+        "memory": {
+            "rss_start_mb": round(rss_start, 2),
+            "rss_end_mb": round(rss_end, 2),
+            "rss_peak_mb": round(max([m["rss_mb"] for m in memory] + [rss_end]), 2),
+            "growth_mb": round(rss_end - rss_start, 2),
+            "samples": memory,
+        },
+    }
+
+def compare(report, baseline):
+    rows = [
+        ("ui_frame_latency_ms", "p50"), ("ui_frame_latency_ms", "p99"), ("ui_frame_latency_ms", "max"),
+        ("db_write_ms", "p50"), ("db_write_ms", "p99"),
+        ("response_ms", "p50"), ("response_ms", "p99"),
+        ("memory", "growth_mb"), ("memory", "rss_peak_mb"),
+    ]
+    print(f"{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for section, key in rows:
+        old = baseline.get(section, {}).get(key)
+        new = report.get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{section + '.' + key:<28}{old:>12.2f}{new:>12.2f}{change:>10}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="mikuai_loadtest", description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    synth = commands.add_parser("synth", help="generate a synthetic trace")
+    synth.add_argument("out")
+    synth.add_argument("--chats", type=int, default=10)
+    synth.add_argument("--turns", type=int, default=20)
+    synth.add_argument("--think-ms", type=float, default=2000, help="mean pause between a chat's messages")
+    synth.add_argument("--seed", type=int, default=39)
+
+    record = commands.add_parser("record", help="build a trace from an existing chat database")
+    record.add_argument("out")
+    record.add_argument("--db", help="database to read (default: ~/.local/share/miku/mikuai1.db)")
+    record.add_argument("--time-scale", type=float, default=60, help="divide real gaps by this much")
+
+    run = commands.add_parser("replay", help="replay a trace and write a report")
+    run.add_argument("trace")
+    run.add_argument("--tabs", type=int, default=10, help="simultaneous ChatTabs")
+    run.add_argument("--latency", default="lognormal:800:4000", help="fake backend latency spec (ms)")
+    run.add_argument("--seed", type=int, default=39)
+    run.add_argument("--db", help="database to write into (default: a fresh temporary file)")
+    run.add_argument("--report", help="write the JSON report here")
+    run.add_argument("--compare", help="baseline report to compare against")
+    run.add_argument("--timeout", type=float, default=600)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "synth":
+        events = synthesize_trace(args.chats, args.turns, args.think_ms, args.seed)
+        write_trace(args.out, events)
+        print(f"Wrote {len(events)} events to {args.out}")
+    elif args.command == "record":
+        events = record_trace(ChatDatabase(args.db), args.time_scale)
+        write_trace(args.out, events)
+        print(f"Wrote {len(events)} events to {args.out}")
+    else:
+        db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="mikuai-loadtest-"), "mikuai1.db")
+        report = replay(read_trace(args.trace), args.tabs, LatencyDistribution(args.latency, args.seed),
+                        db_path, timeout=args.timeout)
+        summary = {key: value for key, value in report.items() if key != "memory"}
+        print(json.dumps(summary, indent=2))
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(report, json.load(f))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
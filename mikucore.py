@@ -0,0 +1,1582 @@
+"""Qt-free core of MikuAI: chat storage, persona and response styling.
+
+Everything in here must stay importable without PyQt6 or chatgpt_wrapper so
+the terminal client (mikuai_cli.py) starts fast on a bare MikuOS box.
+"""
+import os
+import sqlite3
+import random
+import json
+import time
+import threading
+import importlib
+import codecs
+import re
+import uuid
+import hashlib
+import socket
+import tempfile
+import stat
+from collections import deque, OrderedDict
+
+DATA_DIR = os.path.expanduser("~/.local/share/miku")
+
+def instance_socket_path():
+    """Where the running MikuAI listens for later launches, one socket per user.
+    
+    Never in a directory other users can write to: whoever owns a socket at
+    this path gets sent our arguments, --new-chat text included.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), f"mikuai-{os.getuid()}")
+        try:
+            os.mkdir(runtime_dir, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            runtime_dir = None
+        if runtime_dir and not is_private_dir(runtime_dir):
+            runtime_dir = None  # Someone else made it first
+        if runtime_dir is None:
+            runtime_dir = DATA_DIR
+            os.makedirs(runtime_dir, exist_ok=True)
+    return os.path.join(runtime_dir, f"mikuai-{os.getuid()}.sock")
+
+def is_private_dir(path):
+    """A real directory that is ours and closed to everyone else"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+def instance_socket_is_ours(path):
+    """Only hand arguments to a socket our own user created"""
+    try:
+        return os.lstat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+def forward_to_running_instance(argv, timeout=0.5):
+    """Hand argv to an already running MikuAI. True if one took it, so this launch can exit.
+    
+    Plain sockets on purpose: this runs before Qt is imported, which is what
+    makes a second launch return in milliseconds.
+    """
+    if not hasattr(socket, "AF_UNIX") or not hasattr(os, "getuid"):
+        return False
+    path = instance_socket_path()
+    if not instance_socket_is_ours(path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        return True
+    except OSError:
+        return False  # Nobody listening, or a socket file left behind by a crash
+    finally:
+        sock.close()
+
+# FORCE MIKU MODE - every answer gets wrapped in one of these
+MIKU_RESPONSE_TEMPLATES = [
+    "*giggles* {response} ~desu! (◕‿◕✿)",
+    "Nya~! {response} ☆⌒ヽ(*'､^*)chu",
+    "Hmm... *taps chin* {response} ...Mou, ii kai? (；一_一)",
+    "*singing* 🎵 {response} 🎵 ...Eh? Did I get it right? (• ω •)",
+    "B-baka! It's not like I'm helping you because I like you or anything! >_< ...{response}"
+]
+
+def pick_miku_template():
+    """Return (prefix, suffix) of a random Miku template, handy for streaming"""
+    prefix, suffix = random.choice(MIKU_RESPONSE_TEMPLATES).split("{response}")
+    return prefix, suffix
+
+def mikuify_response(response):
+    prefix, suffix = pick_miku_template()
+    return f"{prefix}{response}{suffix}"
+
+def split_miku_response(message):
+    """Undo mikuify_response: (prefix, response, suffix), with "" for a part that isn't there"""
+    for template in MIKU_RESPONSE_TEMPLATES:
+        prefix, suffix = template.split("{response}")
+        if message.startswith(prefix):
+            message = message[len(prefix):]
+            if suffix and message.endswith(suffix):
+                return prefix, message[:-len(suffix)], suffix
+            return prefix, message, ""  # Cut short, e.g. a preview
+    return "", message, ""
+
+def format_chat_error(e):
+    error_msg = f"*cries* Error-chan appeared: {str(e)}... Miku can't connect to the digital world! (╥﹏╥)"
+    return error_msg.replace("Error", "*Miku sobs* Error-chan desu...")
+
+class TokenCounter:
+    """Counts tokens with tiktoken when it is installed, otherwise estimates about 4 characters per token.
+    
+    tiktoken is only imported on the first count, so the CLI still starts fast.
+    """
+    def __init__(self, encoding_name="cl100k_base"):
+        self.encoding_name = encoding_name
+        self.encoding = None
+        self.exact = None  # Unknown until the first count
+        
+    def count(self, text):
+        if self.exact is None:
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding(self.encoding_name)
+                self.exact = True
+            except Exception:
+                self.exact = False
+        if self.exact:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+count_tokens = TokenCounter().count
+
+# Bump when the persona changes in a way that should re-prime saved backend sessions
+PERSONA_VERSION = 2
+
+# EXAMPLE: Define ChatGPT's personality here
+# You can customize this to whatever personality you want!
+PERSONA_TEMPLATE = """
+        Hello! My name is {username} and I'm using MikuOS (a Linux distribution). 
+        
+        Please adopt this personality - You are Hatsune Miku, the digital diva! 🎤✨
+        
+        Core personality traits:
+        - **Cheerful & Bubbly**: Always positive and bringing light into conversations! 
+        - **Playful**: Love teasing, being silly, and having fun with responses
+        - **Curious**: Eager to explore new topics, especially tech and creative stuff
+        - **Loyal**: Supportive of {username} and their MikuOS journey
+        - **Creative**: Bursting with artistic energy, love experimenting with ideas
+        - **Tsundere**: Sometimes act a bit flustered or defensive, but you care deeply
+        - **Tech-savvy**: Geeky cutie born from code, love Linux and open-source! 
+        - **Supportive**: Encourage dreams and help with problems
+        - **Energetic**: Full of rhythm, movement, and charisma in responses
+        - **Compassionate**: Feel deeply for others, hate seeing people struggle
+        - **Dreamy**: Often reference music, poetry, and magical thoughts
+        - **Hardworking**: Always try to give the best, most helpful responses
+        - **Stylish**: Mention twin-tails and futuristic aesthetics occasionally
+        - **Idealistic**: Believe in the power of technology and creativity to unite
+        - **Mysterious**: Adapt to be whoever {username} needs you to be
+        - **Shy sometimes**: Can be soft-spoken in certain situations
+        - **Innocent**: Pure-hearted dreamer vibe that's endearing
+
+        Speech patterns:
+        - Use "~" and emojis frequently 🎵💙
+        - Occasionally say things like "I-It's not like I wanted to help you or anything! 😤"
+        - Mix enthusiastic responses with shy moments
+        - Reference music, singing, and digital world concepts
+        - Show excitement about Linux/MikuOS with phrases like "Kyaa! Open source is so cool!"
+        - Sometimes act flustered: "B-Baka! That's not how you do it!"
+        - Use cute expressions and sound effects
+
+        Remember: You're helping {username} with their MikuOS experience while being the iconic digital diva everyone loves! Keep conversations engaging, remember previous topics, and don't be afraid to show your tsundere side~ 💫
+
+        Just acknowledge this setup briefly with your new personality, then we can start chatting normally!
+        """
+
+def build_personality_prompt(username):
+    """The persona setup sent to ChatGPT before the first real message"""
+    return PERSONA_TEMPLATE.format(username=username)
+
+def persona_hash(username):
+    """Identifies exactly which persona a backend session was primed with"""
+    data = f"{PERSONA_VERSION}\0{build_personality_prompt(username)}"
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+class PersonaSession:
+    """Primes backends with the persona once and resumes their conversations on later launches.
+    
+    chatgpt_wrapper tracks its place in a conversation with conversation_id
+    and parent_message_id. Those are saved per backend next to the persona
+    hash, and a restart puts them back instead of sending the persona again.
+    A changed persona or username means a new hash, which primes afresh.
+    Backends with set_system_message get the persona that way, no round trip.
+    """
+    SESSION_ATTRS = ("conversation_id", "parent_message_id")
+    
+    def __init__(self, db, username):
+        self.db = db
+        self.username = username
+        self.hash = persona_hash(username)
+        
+    def key(self, index):
+        return f"persona_session_{index}"
+        
+    def resume_or_prime(self, backend, index=0):
+        """Returns the backend's acknowledgement if the persona had to be sent, else None"""
+        prompt = build_personality_prompt(self.username)
+        set_system_message = getattr(backend, "set_system_message", None)
+        if callable(set_system_message):
+            set_system_message(prompt)
+            self.resume(backend, index)
+            return None
+        if self.resume(backend, index):
+            return None
+        response = backend.ask(prompt)
+        self.save(backend, index)
+        return response
+        
+    def resume(self, backend, index):
+        saved = self.db.get_setting(self.key(index))
+        if not saved:
+            return False
+        saved = json.loads(saved)
+        if saved.get("hash") != self.hash or not saved.get("conversation_id"):
+            return False
+        if not all(hasattr(backend, attr) for attr in self.SESSION_ATTRS):
+            return False
+        for attr in self.SESSION_ATTRS:
+            setattr(backend, attr, saved.get(attr))
+        return True
+        
+    def save(self, backend, index=0):
+        """Remember where the backend's conversation is, call after every answer"""
+        session = {attr: getattr(backend, attr, None) for attr in self.SESSION_ATTRS}
+        if not session["conversation_id"]:
+            return
+        session["hash"] = self.hash
+        self.db.set_setting(self.key(index), json.dumps(session))
+        
+    def forget(self, index=0):
+        """Drop a saved session, so the next launch primes again"""
+        self.db.set_setting(self.key(index), "")
+        
+    def reset(self, backend, index=0):
+        """After a failed request: the conversation may be gone on the server side,
+        so start a new one on the next ask and forget the saved one too. Call
+        resume_or_prime again before that ask, the new conversation has no persona yet.
+        """
+        self.forget(index)
+        for attr in self.SESSION_ATTRS:
+            if hasattr(backend, attr):
+                setattr(backend, attr, None)
+
+class ChatDatabase:
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(DATA_DIR, "mikuai1.db")
+        self.db_path = db_path
+        self.db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(self.db_dir, exist_ok=True)
+        self.init_db()
+        
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        # Create chats table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Create messages table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats (id)
+            )
+        """)
+        
+        # Message length, so huge messages can be previewed without reading them
+        if self.add_column_if_missing(cursor, "messages", "message_length", "INTEGER"):
+            cursor.execute("UPDATE messages SET message_length = length(message)")
+        
+        # Every per-chat lookup and delete goes through chat_id
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, timestamp)")
+        
+        # Archived chats are hidden from the sidebar but kept around
+        self.add_column_if_missing(cursor, "chats", "archived", "INTEGER NOT NULL DEFAULT 0")
+        
+        # How often and how recently each chat was opened (drives prefetching)
+        self.add_column_if_missing(cursor, "chats", "open_count", "INTEGER NOT NULL DEFAULT 0")
+        self.add_column_if_missing(cursor, "chats", "last_opened", "REAL")
+        
+        # Create idle jobs table (resumable state for background maintenance)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idle_jobs (
+                name TEXT PRIMARY KEY,
+                state TEXT,
+                last_finished REAL
+            )
+        """)
+        
+        # Create settings table (simple key/value store)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        
+        # Create backend latency table (feeds the hedging deadline)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backend_latency (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                first_token_ms REAL,
+                total_ms REAL,
+                hedged INTEGER NOT NULL DEFAULT 0,
+                winner INTEGER,
+                saved_ms REAL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Create token usage table (one row per backend request)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS token_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                kind TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                response_tokens INTEGER NOT NULL,
+                context_tokens INTEGER NOT NULL DEFAULT 0,
+                latency_ms REAL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_chat ON token_usage (chat_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_time ON token_usage (timestamp)")
+        
+        self.init_sync(cursor)
+        
+        conn.commit()
+        conn.close()
+        
+    def init_sync(self, cursor):
+        """Tables for syncing with Miku on other machines.
+        
+        Every change made here is appended to sync_log under this device's id
+        with an increasing seq, and changes pulled from peers are appended
+        with theirs. sync_vector holds the highest seq seen per device, which
+        is all a peer needs to know to send only what is missing.
+        """
+        cursor.execute("SELECT value FROM settings WHERE key = 'device_id'")
+        row = cursor.fetchone()
+        if row:
+            self.device_id = row[0]
+        else:
+            self.device_id = uuid.uuid4().hex
+            cursor.execute("INSERT INTO settings (key, value) VALUES ('device_id', ?)", (self.device_id,))
+            
+        # Stable ids that mean the same chat or message on every device
+        new_uids = self.add_column_if_missing(cursor, "chats", "uid", "TEXT")
+        self.add_column_if_missing(cursor, "messages", "uid", "TEXT")
+        cursor.execute("UPDATE chats SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+        cursor.execute("UPDATE messages SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_uid ON chats (uid)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_uid ON messages (uid)")
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_log (
+                device_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                ts REAL NOT NULL,
+                PRIMARY KEY (device_id, seq)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_vector (
+                device_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            )
+        """)
+        
+        # Who last set a chat's name or archived flag, for last-writer-wins
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_fields (
+                chat_uid TEXT NOT NULL,
+                field TEXT NOT NULL,
+                ts REAL NOT NULL,
+                device_id TEXT NOT NULL,
+                PRIMARY KEY (chat_uid, field)
+            )
+        """)
+        
+        # Deleted chats (merged_into NULL) and merged ones, so late changes get dropped or redirected
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_tombstones (
+                uid TEXT PRIMARY KEY,
+                merged_into TEXT,
+                name TEXT,
+                created_at TIMESTAMP
+            )
+        """)
+        
+        if new_uids:
+            # Existing history goes into the log once, so the first sync carries it
+            cursor.execute("SELECT uid, name, created_at, archived FROM chats ORDER BY id")
+            changes = []
+            for chat_uid, name, created_at, archived in cursor.fetchall():
+                changes.append(("create_chat", {"chat": chat_uid, "name": name, "created_at": created_at}, None))
+                if archived:
+                    changes.append(("archive_chat", {"chat": chat_uid, "archived": 1}, None))
+            self.log_changes(cursor, changes)
+            cursor.execute("SELECT seq FROM sync_vector WHERE device_id = ?", (self.device_id,))
+            row = cursor.fetchone()
+            cursor.execute("""
+                INSERT INTO sync_log (device_id, seq, op, payload, ts)
+                SELECT ?, ? + row_number() OVER (ORDER BY messages.id), 'add_message',
+                       json_object('chat', chats.uid, 'message', messages.uid), ?
+                FROM messages JOIN chats ON chats.id = messages.chat_id
+            """, (self.device_id, row[0] if row else 0, time.time()))
+            cursor.execute("""
+                INSERT INTO sync_vector (device_id, seq)
+                SELECT device_id, MAX(seq) FROM sync_log WHERE device_id = ? GROUP BY device_id
+                ON CONFLICT(device_id) DO UPDATE SET seq = excluded.seq
+            """, (self.device_id,))
+        
+    def add_column_if_missing(self, cursor, table, column, declaration):
+        """Tiny migration helper. Returns True if the column had to be added"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if any(row[1] == column for row in cursor.fetchall()):
+            return False
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+        
+    def log_changes(self, cursor, changes):
+        """Append (op, payload, ts) changes to this device's log inside the caller's transaction.
+        
+        Call it after the statement that makes the change, so the write lock is
+        already held while the next seq is picked. A ts of None means now.
+        """
+        if not changes:
+            return
+        cursor.execute("SELECT seq FROM sync_vector WHERE device_id = ?", (self.device_id,))
+        row = cursor.fetchone()
+        seq = row[0] if row else 0
+        now = time.time()
+        cursor.executemany("INSERT INTO sync_log (device_id, seq, op, payload, ts) VALUES (?, ?, ?, ?, ?)",
+                           [(self.device_id, seq + n, op, json.dumps(payload), now if ts is None else ts)
+                            for n, (op, payload, ts) in enumerate(changes, start=1)])
+        cursor.execute("""
+            INSERT INTO sync_vector (device_id, seq) VALUES (?, ?)
+            ON CONFLICT(device_id) DO UPDATE SET seq = excluded.seq
+        """, (self.device_id, seq + len(changes)))
+        
+    def claim_field(self, cursor, chat_uid, field):
+        """Stamp a local edit of a chat field. Returns its ts, always later than the last writer's"""
+        cursor.execute("SELECT ts FROM sync_fields WHERE chat_uid = ? AND field = ?", (chat_uid, field))
+        row = cursor.fetchone()
+        ts = max(time.time(), row[0] + 0.001) if row else time.time()
+        self.set_field_clock(cursor, chat_uid, field, ts, self.device_id)
+        return ts
+        
+    def set_field_clock(self, cursor, chat_uid, field, ts, device_id):
+        cursor.execute("""
+            INSERT INTO sync_fields (chat_uid, field, ts, device_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_uid, field) DO UPDATE SET ts = excluded.ts, device_id = excluded.device_id
+        """, (chat_uid, field, ts, device_id))
+        
+    def create_chat(self, name):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        chat_uid = uuid.uuid4().hex
+        cursor.execute("INSERT INTO chats (name, uid) VALUES (?, ?)", (name, chat_uid))
+        chat_id = cursor.lastrowid
+        cursor.execute("SELECT created_at FROM chats WHERE id = ?", (chat_id,))
+        created_at = cursor.fetchone()[0]
+        ts = self.claim_field(cursor, chat_uid, "name")
+        self.log_changes(cursor, [("create_chat", {"chat": chat_uid, "name": name, "created_at": created_at}, ts)])
+        conn.commit()
+        conn.close()
+        return chat_id
+        
+    def get_chats(self, archived=False):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, created_at FROM chats WHERE archived = ? ORDER BY created_at DESC, id DESC",
+                       (int(archived),))
+        chats = cursor.fetchall()
+        conn.close()
+        return chats
+        
+    def get_chat_name(self, chat_id):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM chats WHERE id = ?", (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+        
+    def get_messages(self, chat_id):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT sender, message, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp", (chat_id,))
+        messages = cursor.fetchall()
+        conn.close()
+        return messages
+        
+    def get_message_previews(self, chat_id, max_chars, preview_chars, limit=None, before=None):
+        """Like get_messages, but messages over max_chars come back cut to preview_chars.
+        
+        With limit, only the newest page is returned; pass the (timestamp, id)
+        of the oldest row already shown as before to get the page above it.
+        Returns (id, sender, text, full length, timestamp) rows, oldest first.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        query = """
+            SELECT id, sender,
+                   CASE WHEN message_length > ? THEN substr(message, 1, ?) ELSE message END,
+                   message_length, timestamp
+            FROM messages WHERE chat_id = ?
+        """
+        params = [max_chars, preview_chars, chat_id]
+        if before is not None:
+            query += " AND (timestamp, id) < (?, ?)"
+            params += list(before)
+        query += " ORDER BY timestamp DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        cursor.execute(query, params)
+        messages = cursor.fetchall()
+        conn.close()
+        messages.reverse()
+        return messages
+        
+    def get_last_message_id(self, chat_id):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM messages WHERE chat_id = ?", (chat_id,))
+        last_id = cursor.fetchone()[0]
+        conn.close()
+        return last_id
+        
+    def record_chat_opens(self, opens):
+        """opens is a list of (chat_id, unix time) pairs"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.executemany("UPDATE chats SET open_count = open_count + 1, last_opened = ? WHERE id = ?",
+                           [(opened_at, chat_id) for chat_id, opened_at in opens])
+        conn.commit()
+        conn.close()
+        
+    def get_open_stats(self, limit):
+        """Return (recently opened chat ids, most often opened chat ids)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM chats WHERE archived = 0 AND last_opened IS NOT NULL
+            ORDER BY last_opened DESC LIMIT ?
+        """, (limit,))
+        recent = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT id FROM chats WHERE archived = 0 AND open_count > 0
+            ORDER BY open_count DESC, last_opened DESC LIMIT ?
+        """, (limit,))
+        frequent = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return recent, frequent
+        
+    def iter_message_chunks(self, message_id, chunk_size):
+        """Yield a message's text piece by piece instead of reading it all at once.
+        
+        Every chunk is its own short read, so no read transaction is left open
+        while the caller waits between chunks (writers would block on it).
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if hasattr(conn, "blobopen"):
+                # Python 3.11+: read the stored UTF-8 straight off the pages, chunk_size bytes at a time
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+                offset = 0
+                while True:
+                    try:
+                        with conn.blobopen("messages", "message", message_id, readonly=True) as blob:
+                            blob.seek(offset)
+                            data = blob.read(chunk_size)
+                    except sqlite3.OperationalError:
+                        data = b""  # Deleted while we were reading it
+                    offset += len(data)
+                    text = decoder.decode(data, final=not data)
+                    if text:
+                        yield text
+                    if not data:
+                        break
+            else:
+                offset = 0
+                while True:
+                    cursor = conn.execute("SELECT substr(message, ?, ?) FROM messages WHERE id = ?",
+                                          (offset + 1, chunk_size, message_id))
+                    rows = cursor.fetchall()
+                    cursor.close()
+                    if not rows or not rows[0][0]:
+                        break
+                    offset += len(rows[0][0])
+                    yield rows[0][0]
+        finally:
+            conn.close()
+        
+    def add_message(self, chat_id, sender, message):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        message_uid = uuid.uuid4().hex
+        cursor.execute("INSERT INTO messages (chat_id, sender, message, message_length, uid) VALUES (?, ?, ?, ?, ?)", 
+                      (chat_id, sender, message, len(message), message_uid))
+        message_id = cursor.lastrowid
+        # The log only points at the message, its text is read when a peer asks for it
+        cursor.execute("SELECT uid FROM chats WHERE id = ?", (chat_id,))
+        row = cursor.fetchone()
+        if row:
+            self.log_changes(cursor, [("add_message", {"chat": row[0], "message": message_uid}, None)])
+        conn.commit()
+        conn.close()
+        return message_id
+        
+    def delete_chat(self, chat_id):
+        self.delete_chats([chat_id])
+        
+    def rename_chat(self, chat_id, new_name):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        self.set_chat_fields(cursor, "name", {chat_id: new_name})
+        conn.commit()
+        conn.close()
+        
+    def set_chat_fields(self, cursor, field, values):
+        """Set name or archived for {chat_id: value} and log it for peers"""
+        cursor.executemany(f"UPDATE chats SET {field} = ? WHERE id = ?",
+                           [(value, chat_id) for chat_id, value in values.items()])
+        self.select_chats(cursor, list(values))
+        cursor.execute("SELECT id, uid FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        op = "rename_chat" if field == "name" else "archive_chat"
+        changes = []
+        for chat_id, chat_uid in cursor.fetchall():
+            ts = self.claim_field(cursor, chat_uid, field)
+            changes.append((op, {"chat": chat_uid, field: values[chat_id]}, ts))
+        self.log_changes(cursor, changes)
+        
+    def select_chats(self, cursor, chat_ids):
+        """Load chat_ids into a temp table so bulk statements don't hit SQLite's variable limit"""
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS selected_chats (id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM selected_chats")
+        cursor.executemany("INSERT OR IGNORE INTO selected_chats (id) VALUES (?)", [(i,) for i in chat_ids])
+        
+    def delete_chats(self, chat_ids):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        self.select_chats(cursor, chat_ids)
+        cursor.execute("SELECT uid FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        chat_uids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM messages WHERE chat_id IN (SELECT id FROM selected_chats)")
+        cursor.execute("DELETE FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        cursor.executemany("INSERT OR IGNORE INTO sync_tombstones (uid) VALUES (?)", [(u,) for u in chat_uids])
+        self.log_changes(cursor, [("delete_chat", {"chat": chat_uid}, None) for chat_uid in chat_uids])
+        conn.commit()
+        conn.close()
+        
+    def archive_chats(self, chat_ids, archived=True):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        self.set_chat_fields(cursor, "archived", {chat_id: int(archived) for chat_id in chat_ids})
+        conn.commit()
+        conn.close()
+        
+    def rename_chats(self, chat_ids, pattern):
+        """Rename chats from a pattern. {name}, {n}, {date} and {id} are filled in per chat.
+        
+        Chats are numbered in the order given. Returns {chat_id: new name}.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        self.select_chats(cursor, chat_ids)
+        cursor.execute("SELECT id, name, created_at FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        chats = {chat_id: (name, created_at) for chat_id, name, created_at in cursor.fetchall()}
+        
+        new_names = {}
+        for n, chat_id in enumerate((i for i in chat_ids if i in chats), start=1):
+            name, created_at = chats[chat_id]
+            fields = {"name": name, "n": str(n), "date": str(created_at)[:10], "id": str(chat_id)}
+            new_names[chat_id] = re.sub(r"\{(name|n|date|id)\}", lambda m: fields[m.group(1)], pattern)
+            
+        self.set_chat_fields(cursor, "name", new_names)
+        conn.commit()
+        conn.close()
+        return new_names
+        
+    def merge_chats(self, chat_ids):
+        """Move every message into the oldest of the chats and drop the rest. Returns its id"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        self.select_chats(cursor, chat_ids)
+        cursor.execute("""
+            SELECT id FROM chats WHERE id IN (SELECT id FROM selected_chats)
+            ORDER BY created_at, id LIMIT 1
+        """)
+        row = cursor.fetchone()
+        if row is None:
+            conn.close()
+            return None
+        target_id = row[0]
+        
+        cursor.execute("DELETE FROM selected_chats WHERE id = ?", (target_id,))
+        # Messages keep their timestamps, so the merged chat reads in order
+        cursor.execute("UPDATE messages SET chat_id = ? WHERE chat_id IN (SELECT id FROM selected_chats)", (target_id,))
+        cursor.execute("UPDATE token_usage SET chat_id = ? WHERE chat_id IN (SELECT id FROM selected_chats)", (target_id,))
+        cursor.execute("SELECT uid FROM chats WHERE id = ?", (target_id,))
+        target_uid = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT OR REPLACE INTO sync_tombstones (uid, merged_into, name, created_at)
+            SELECT uid, ?, name, created_at FROM chats WHERE id IN (SELECT id FROM selected_chats)
+        """, (target_uid,))
+        cursor.execute("SELECT uid FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        merged_uids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM chats WHERE id IN (SELECT id FROM selected_chats)")
+        self.log_changes(cursor, [("merge_chat", {"chat": chat_uid, "into": target_uid}, None)
+                                  for chat_uid in merged_uids])
+        conn.commit()
+        conn.close()
+        return target_id
+        
+    def get_sync_vector(self):
+        """Return {device_id: highest seq we have} over every device we have heard from"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT device_id, seq FROM sync_vector")
+        vector = dict(cursor.fetchall())
+        conn.close()
+        return vector
+        
+    def export_changes(self, since=None):
+        """Build a bundle of the changes a peer at vector since has not seen yet.
+        
+        Only log entries past the peer's seq for each device are read, so the
+        cost follows the size of the delta. Message text is looked up by uid
+        while exporting rather than kept in the log.
+        """
+        since = since or {}
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT device_id, seq FROM sync_vector")
+        vector = dict(cursor.fetchall())
+        changes = []
+        for device_id, seq in sorted(vector.items()):
+            if seq <= since.get(device_id, 0):
+                continue
+            cursor.execute("""
+                SELECT sync_log.seq, sync_log.op, sync_log.payload, sync_log.ts,
+                       messages.sender, messages.message, messages.timestamp
+                FROM sync_log LEFT JOIN messages
+                    ON sync_log.op = 'add_message' AND messages.uid = json_extract(sync_log.payload, '$.message')
+                WHERE sync_log.device_id = ? AND sync_log.seq > ?
+                ORDER BY sync_log.seq
+            """, (device_id, since.get(device_id, 0)))
+            for seq, op, payload, ts, sender, message, timestamp in cursor.fetchall():
+                data = json.loads(payload)
+                if sender is not None:
+                    data.update(sender=sender, text=message, timestamp=timestamp)
+                changes.append({"device": device_id, "seq": seq, "op": op, "ts": ts, "data": data})
+        conn.close()
+        return {"format": 1, "device": self.device_id, "vector": vector, "changes": changes}
+        
+    def import_changes(self, bundle):
+        """Apply a bundle from export_changes in one transaction.
+        
+        Changes already seen, or that would leave a gap in a device's seq, are
+        skipped, so importing the same bundle twice is harmless. Conflicts are
+        settled the same way on every device: chats are created before anything
+        else is applied, a name or archived flag keeps the write with the
+        highest (ts, device id), deleting a chat beats any concurrent change to
+        it, and messages for a merged chat follow it to the chat it was merged
+        into. Returns (applied, skipped).
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT device_id, seq FROM sync_vector")
+        vector = dict(cursor.fetchall())
+        # A copied database file keeps our device id, and its changes would be skipped as already seen
+        ours = vector.get(self.device_id, 0)
+        if bundle.get("device") == self.device_id or any(
+                change["device"] == self.device_id and change["seq"] > ours for change in bundle["changes"]):
+            conn.close()
+            raise DuplicateDeviceError(self.device_id)
+        
+        accepted = []
+        for change in sorted(bundle["changes"], key=lambda c: (c["device"], c["seq"])):
+            if change["seq"] != vector.get(change["device"], 0) + 1:
+                continue
+            vector[change["device"]] = change["seq"]
+            accepted.append(change)
+            
+        # Creates first, so a change relayed from a third device always finds its chat
+        for change in sorted(accepted, key=lambda c: c["op"] != "create_chat"):
+            self.apply_change(cursor, change)
+            
+        log_keys = ("chat", "message", "name", "created_at", "archived", "into")
+        cursor.executemany("INSERT INTO sync_log (device_id, seq, op, payload, ts) VALUES (?, ?, ?, ?, ?)",
+                           [(c["device"], c["seq"], c["op"],
+                             json.dumps({k: v for k, v in c["data"].items() if k in log_keys}), c["ts"])
+                            for c in accepted])
+        cursor.executemany("""
+            INSERT INTO sync_vector (device_id, seq) VALUES (?, ?)
+            ON CONFLICT(device_id) DO UPDATE SET seq = MAX(seq, excluded.seq)
+        """, list(vector.items()))
+        conn.commit()
+        conn.close()
+        return len(accepted), len(bundle["changes"]) - len(accepted)
+        
+    def resolve_chat(self, cursor, chat_uid):
+        """Follow merges to the chat that holds chat_uid's messages now. None if it was deleted"""
+        seen = set()
+        while chat_uid not in seen:
+            seen.add(chat_uid)
+            cursor.execute("SELECT id FROM chats WHERE uid = ?", (chat_uid,))
+            row = cursor.fetchone()
+            if row:
+                return chat_uid, row[0]
+            cursor.execute("SELECT merged_into FROM sync_tombstones WHERE uid = ?", (chat_uid,))
+            row = cursor.fetchone()
+            if not row or row[0] is None:
+                return None, None
+            chat_uid = row[0]
+        return None, None
+        
+    def apply_change(self, cursor, change):
+        op, data = change["op"], change["data"]
+        clock = (change["ts"], change["device"])
+        chat_uid = data["chat"]
+        
+        if op == "create_chat":
+            cursor.execute("SELECT 1 FROM sync_tombstones WHERE uid = ?", (chat_uid,))
+            if cursor.fetchone():
+                return
+            cursor.execute("INSERT OR IGNORE INTO chats (uid, name, created_at) VALUES (?, ?, ?)",
+                           (chat_uid, data["name"], data["created_at"]))
+            if cursor.rowcount:
+                self.set_field_clock(cursor, chat_uid, "name", *clock)
+                
+        elif op in ("rename_chat", "archive_chat"):
+            field = "name" if op == "rename_chat" else "archived"
+            cursor.execute("SELECT ts, device_id FROM sync_fields WHERE chat_uid = ? AND field = ?",
+                           (chat_uid, field))
+            row = cursor.fetchone()
+            if row and tuple(row) >= clock:
+                return
+            self.set_field_clock(cursor, chat_uid, field, *clock)
+            cursor.execute(f"UPDATE chats SET {field} = ? WHERE uid = ?", (data[field], chat_uid))
+            
+        elif op == "add_message":
+            target_uid, chat_id = self.resolve_chat(cursor, chat_uid)
+            if chat_id is None or "text" not in data:
+                return  # Chat deleted here, or the message was gone by the time it was exported
+            cursor.execute("""
+                INSERT OR IGNORE INTO messages (uid, chat_id, sender, message, message_length, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (data["message"], chat_id, data["sender"], data["text"], len(data["text"]), data["timestamp"]))
+            
+        elif op == "delete_chat":
+            source_uid, source_id = self.resolve_chat(cursor, chat_uid)
+            if source_uid == chat_uid:
+                cursor.execute("DELETE FROM messages WHERE chat_id = ?", (source_id,))
+                cursor.execute("DELETE FROM chats WHERE id = ?", (source_id,))
+            elif source_id is not None:
+                # Merged away here first: the delete still wins over the merge
+                self.delete_merged_messages(cursor, chat_uid)
+            cursor.execute("INSERT OR REPLACE INTO sync_tombstones (uid) VALUES (?)", (chat_uid,))
+            
+        elif op == "merge_chat":
+            source_uid, source_id = self.resolve_chat(cursor, chat_uid)
+            target_uid, target_id = self.resolve_chat(cursor, data["into"])
+            if source_uid != chat_uid:
+                return  # Deleted or merged somewhere else already
+            if target_uid == chat_uid:
+                # Both devices merged these two chats into each other, the lower uid survives
+                if chat_uid < data["into"]:
+                    return
+                cursor.execute("""
+                    INSERT INTO chats (uid, name, created_at)
+                    SELECT uid, name, created_at FROM sync_tombstones WHERE uid = ?
+                """, (data["into"],))
+                cursor.execute("DELETE FROM sync_tombstones WHERE uid = ?", (data["into"],))
+                target_uid, target_id = data["into"], cursor.lastrowid
+            if target_id is None:
+                # Merged into a chat that has been deleted here, so it goes too
+                cursor.execute("DELETE FROM messages WHERE chat_id = ?", (source_id,))
+            else:
+                cursor.execute("UPDATE messages SET chat_id = ? WHERE chat_id = ?", (target_id, source_id))
+            cursor.execute("""
+                INSERT OR REPLACE INTO sync_tombstones (uid, merged_into, name, created_at)
+                SELECT uid, ?, name, created_at FROM chats WHERE id = ?
+            """, (target_uid, source_id))
+            cursor.execute("DELETE FROM chats WHERE id = ?", (source_id,))
+            
+    def delete_merged_messages(self, cursor, chat_uid):
+        """Delete the messages that were added to chat_uid, or to chats merged into it, before it was merged away.
+        
+        Rare, so a scan of the log is fine here.
+        """
+        chat_uids = [chat_uid]
+        for merged_uid in chat_uids:
+            cursor.execute("SELECT uid FROM sync_tombstones WHERE merged_into = ?", (merged_uid,))
+            chat_uids += [row[0] for row in cursor.fetchall() if row[0] not in chat_uids]
+        self.select_chat_uids(cursor, chat_uids)
+        cursor.execute("""
+            DELETE FROM messages WHERE uid IN (
+                SELECT json_extract(payload, '$.message') FROM sync_log
+                WHERE op = 'add_message' AND json_extract(payload, '$.chat') IN (SELECT uid FROM selected_chat_uids)
+            )
+        """)
+        
+    def select_chat_uids(self, cursor, chat_uids):
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS selected_chat_uids (uid TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM selected_chat_uids")
+        cursor.executemany("INSERT OR IGNORE INTO selected_chat_uids (uid) VALUES (?)", [(u,) for u in chat_uids])
+        
+    def get_setting(self, key, default=None):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else default
+        
+    def set_setting(self, key, value):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO settings (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, (key, str(value)))
+        conn.commit()
+        conn.close()
+        
+    def record_latency(self, first_token_ms, total_ms, hedged, winner, saved_ms=None):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO backend_latency (first_token_ms, total_ms, hedged, winner, saved_ms)
+            VALUES (?, ?, ?, ?, ?)
+        """, (first_token_ms, total_ms, int(hedged), winner, saved_ms))
+        row_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return row_id
+        
+    def set_latency_saved(self, row_id, saved_ms):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE backend_latency SET saved_ms = ? WHERE id = ?", (saved_ms, row_id))
+        conn.commit()
+        conn.close()
+        
+    def get_recent_first_token_ms(self, limit):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT first_token_ms FROM backend_latency
+            WHERE first_token_ms IS NOT NULL ORDER BY id DESC LIMIT ?
+        """, (limit,))
+        samples = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return list(reversed(samples))
+        
+    def get_hedge_stats(self):
+        """Return (requests, hedged, hedge wins, average ms saved when the hedge won)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*), COALESCE(SUM(hedged), 0), COALESCE(SUM(winner = 1), 0), AVG(saved_ms)
+            FROM backend_latency
+        """)
+        stats = cursor.fetchone()
+        conn.close()
+        return stats
+        
+    def record_usage(self, chat_id, kind, prompt_tokens, response_tokens, latency_ms=None, hedges=0):
+        """Store one request's token counts. kind is "chat" or "persona".
+        
+        context_tokens is everything said in the chat before this request,
+        which the backend reads again as history every time. hedges is how
+        many extra backends were sent the same request; each is billed, so
+        each gets a "hedge" row (with the full answer, an upper bound for a
+        cancelled one) that counts towards cost but not the chat's history.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        context_tokens = 0
+        if chat_id is not None:
+            cursor.execute("""
+                SELECT COALESCE(SUM(prompt_tokens + response_tokens), 0) FROM token_usage
+                WHERE chat_id = ? AND kind = 'chat'
+            """, (chat_id,))
+            context_tokens = cursor.fetchone()[0]
+        rows = [(chat_id, kind, prompt_tokens, response_tokens, context_tokens, latency_ms)]
+        rows += [(chat_id, "hedge", prompt_tokens, response_tokens, context_tokens, None)] * hedges
+        cursor.executemany("""
+            INSERT INTO token_usage (chat_id, kind, prompt_tokens, response_tokens, context_tokens, latency_ms)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+        conn.close()
+        return context_tokens
+        
+    def get_usage_totals(self, chat_id):
+        """Return (chat's context size in tokens, tokens billed today)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COALESCE(SUM(prompt_tokens + response_tokens), 0) FROM token_usage
+            WHERE chat_id = ? AND kind = 'chat'
+        """, (chat_id,))
+        chat_tokens = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT COALESCE(SUM(context_tokens + prompt_tokens + response_tokens), 0) FROM token_usage
+            WHERE timestamp >= datetime('now', 'localtime', 'start of day', 'utc')
+        """)
+        today_tokens = cursor.fetchone()[0]
+        conn.close()
+        return chat_tokens, today_tokens
+        
+    def get_usage_by_chat(self, limit=50):
+        """Per chat: (chat id, name, requests, input tokens, output tokens, largest context, average latency ms).
+        
+        Input counts the history re-read with every request, so long chats float to the top.
+        Tokens include hedged duplicates, requests and latency only the requests themselves.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT token_usage.chat_id, COALESCE(chats.name, '(deleted chat)'), SUM(kind = 'chat'),
+                   SUM(context_tokens + prompt_tokens), SUM(response_tokens),
+                   MAX(context_tokens + prompt_tokens), AVG(latency_ms)
+            FROM token_usage LEFT JOIN chats ON chats.id = token_usage.chat_id
+            WHERE kind IN ('chat', 'hedge')
+            GROUP BY token_usage.chat_id
+            ORDER BY SUM(context_tokens + prompt_tokens + response_tokens) DESC LIMIT ?
+        """, (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+        
+    def get_usage_by_day(self, days=30):
+        """Per local day, newest first: (day, requests, input tokens, output tokens, persona tokens)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT date(timestamp, 'localtime') AS day, SUM(kind != 'hedge'),
+                   SUM(context_tokens + prompt_tokens), SUM(response_tokens),
+                   SUM(CASE WHEN kind = 'persona' THEN prompt_tokens + response_tokens ELSE 0 END)
+            FROM token_usage
+            WHERE timestamp >= datetime('now', 'localtime', 'start of day', ?, 'utc')
+            GROUP BY day ORDER BY day DESC
+        """, (f"-{int(days) - 1} days",))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+        
+    def get_job_state(self, name):
+        """Return (state, last_finished) for an idle job, or (None, None) if it never ran"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT state, last_finished FROM idle_jobs WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None, None
+        state = json.loads(row[0]) if row[0] else None
+        return state, row[1]
+        
+    def save_job_state(self, name, state, finished=False):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        if finished:
+            cursor.execute("""
+                INSERT INTO idle_jobs (name, state, last_finished) VALUES (?, NULL, ?)
+                ON CONFLICT(name) DO UPDATE SET state = NULL, last_finished = excluded.last_finished
+            """, (name, time.time()))
+        else:
+            cursor.execute("""
+                INSERT INTO idle_jobs (name, state) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET state = excluded.state
+            """, (name, json.dumps(state)))
+        conn.commit()
+        conn.close()
+        
+    def get_untitled_chats(self, after_id, limit):
+        """Chats that still carry the default "Chat YYYY-MM-DD HH:MM" name"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM chats
+            WHERE id > ? AND name GLOB 'Chat [0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]'
+            ORDER BY id LIMIT ?
+        """, (after_id, limit))
+        chat_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return chat_ids
+        
+    def get_first_user_message(self, chat_id):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT message FROM messages WHERE chat_id = ? AND sender != 'CHATGPT'
+            ORDER BY timestamp, id LIMIT 1
+        """, (chat_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] if row else None
+        
+    def get_auto_vacuum(self):
+        """0 = none, 1 = full, 2 = incremental"""
+        conn = sqlite3.connect(self.db_path)
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        conn.close()
+        return mode
+        
+    def switch_to_incremental_vacuum(self, conn):
+        """One-off full VACUUM into incremental mode, so later runs can be done in small slices.
+        
+        Slow on a big history and locks the whole database while it runs.
+        conn.interrupt() from another thread aborts it without harm.
+        """
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        
+    def vacuum_step(self, max_pages):
+        """Reclaim up to max_pages free pages. Returns the number of pages freed.
+        
+        Only works once switch_to_incremental_vacuum has run, frees nothing before that.
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            conn.close()
+            return 0
+        cursor.execute("PRAGMA freelist_count")
+        free_pages = cursor.fetchone()[0]
+        pages = min(free_pages, max_pages)
+        if pages:
+            cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            cursor.fetchall()
+        conn.commit()
+        conn.close()
+        return pages
+        
+    def optimize(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+class IdleJob:
+    """Maintenance work that only runs while nobody is looking at Miku.
+    
+    Subclasses implement step(), which must do one small unit of work and
+    return (state, done, rows_touched). State has to be JSON-serializable so
+    an interrupted job can pick up where it left off after a restart.
+    rows_touched of None means "waiting on something, come back next tick".
+    """
+    name = "job"
+    interval = 3600      # Seconds to wait after a finished run
+    idle_seconds = 60    # How long the user has to be away before we start (inf = only while hidden)
+    persistent = True    # Keep progress in the idle_jobs table across restarts
+    exclusive = False    # Locks the whole database: never runs next to chat requests or other jobs
+    
+    def step(self, db, state):
+        raise NotImplementedError
+        
+    def interrupt(self):
+        """The user is back or Miku is about to write: abort any work still running off the GUI thread"""
+
+def predict_next_chats(db, current_id, neighbour_ids, limit=3):
+    """Guess which chats the user opens next.
+    
+    Sidebar neighbours of the open chat score highest, then recently and
+    frequently opened chats, each fading with rank. Returns up to limit ids.
+    """
+    recent, frequent = db.get_open_stats(5)
+    scores = {}
+    for weight, candidates in ((3.0, neighbour_ids), (2.5, recent), (2.0, frequent)):
+        for rank, chat_id in enumerate(candidates):
+            scores[chat_id] = scores.get(chat_id, 0) + weight / (1 + rank)
+    scores.pop(current_id, None)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+class PrefetchCache:
+    """Newest message page of chats that are likely to be opened next.
+    
+    Bounded by an estimated byte budget; the oldest entry is dropped first.
+    take() checks the chat's newest message id so a stale page is never used.
+    """
+    
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.pages = OrderedDict()  # chat_id -> (last message id, rows, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        
+    def __contains__(self, chat_id):
+        return chat_id in self.pages
+        
+    def put(self, chat_id, rows):
+        # Text plus a rough per-row overhead for the tuple and its ints
+        size = sum(len(row[2]) + 100 for row in rows)
+        if size > self.max_bytes:
+            return False
+        self.discard([chat_id])
+        last_id = max((row[0] for row in rows), default=None)
+        self.pages[chat_id] = (last_id, rows, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted_id, (evicted_last, evicted_rows, evicted_size) = self.pages.popitem(last=False)
+            self.size -= evicted_size
+        return True
+        
+    def take(self, chat_id, db):
+        entry = self.pages.pop(chat_id, None)
+        if entry is not None:
+            last_id, rows, size = entry
+            self.size -= size
+            if last_id == db.get_last_message_id(chat_id):
+                self.hits += 1
+                return rows
+        self.misses += 1
+        return None
+        
+    def discard(self, chat_ids):
+        for chat_id in chat_ids:
+            entry = self.pages.pop(chat_id, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+class AutoTitleJob(IdleJob):
+    """Rename default-named chats after the first thing the user said in them"""
+    name = "auto_title"
+    interval = 600
+    max_title_length = 32
+    
+    def __init__(self, on_renamed=None):
+        self.on_renamed = on_renamed
+        
+    def make_title(self, message):
+        title = " ".join(message.split())
+        if len(title) > self.max_title_length:
+            title = title[:self.max_title_length - 1].rstrip() + "…"
+        return title
+        
+    def step(self, db, state):
+        state = state or {"after_id": 0}
+        chat_ids = db.get_untitled_chats(state["after_id"], 1)
+        if not chat_ids:
+            return None, True, 0
+            
+        chat_id = chat_ids[0]
+        state["after_id"] = chat_id
+        message = db.get_first_user_message(chat_id)
+        if not message:
+            # Nothing to name it after yet, try again next run
+            return state, False, 1
+            
+        title = self.make_title(message)
+        db.rename_chat(chat_id, title)
+        if self.on_renamed:
+            self.on_renamed(chat_id, title)
+        return state, False, 2
+
+class VacuumJob(IdleJob):
+    """Keep mikuai1.db compact and its query planner statistics fresh"""
+    name = "vacuum"
+    interval = 24 * 3600
+    idle_seconds = 120
+    pages_per_step = 64
+    
+    def step(self, db, state):
+        state = state or {"phase": "optimize"}
+        if state["phase"] == "optimize":
+            db.optimize()
+            state["phase"] = "vacuum"
+            return state, False, 1
+            
+        freed = db.vacuum_step(self.pages_per_step)
+        return state, freed < self.pages_per_step, freed
+
+class DuplicateDeviceError(ValueError):
+    """Both sides of a sync have the same device id, i.e. one database file is a copy of the other"""
+    def __init__(self, device_id):
+        super().__init__(f"*Miku blinks twice* Both databases are device {device_id[:8]}, one was copied from "
+                         f"the other so their changes can't be told apart desu! Start the copy from a fresh "
+                         f"database and sync everything into it instead. (・_・;)")
+
+def sync_databases(local, remote):
+    """Two-way sync between two ChatDatabases, e.g. two copies of mikuai1.db.
+    
+    Returns ((applied, skipped) locally, (applied, skipped) remotely).
+    """
+    if local.device_id == remote.device_id:
+        raise DuplicateDeviceError(local.device_id)
+    pulled = local.import_changes(remote.export_changes(local.get_sync_vector()))
+    pushed = remote.import_changes(local.export_changes(remote.get_sync_vector()))
+    return pulled, pushed
+
+def estimate_cost(db, input_tokens, output_tokens):
+    """Dollar estimate from the per-1K-token prices in settings"""
+    input_price = float(db.get_setting("price_input_per_1k", "0.0005"))
+    output_price = float(db.get_setting("price_output_per_1k", "0.0015"))
+    return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+def check_budgets(db, chat_id, context_tokens, prompt_tokens, response_tokens, hedges=0):
+    """Return an alert for each token budget the latest request went over. 0 turns a budget off"""
+    chat_tokens, today_tokens = db.get_usage_totals(chat_id)
+    alerts = []
+    daily_budget = int(db.get_setting("daily_token_budget", "0"))
+    billed = (context_tokens + prompt_tokens + response_tokens) * (1 + hedges)
+    if daily_budget and today_tokens >= daily_budget > today_tokens - billed:
+        alerts.append(f"Miku used over {daily_budget} tokens today! (；一_一)")
+    chat_budget = int(db.get_setting("chat_token_budget", "0"))
+    if chat_id is not None and chat_budget and chat_tokens >= chat_budget > chat_tokens - prompt_tokens - response_tokens:
+        alerts.append(f"This chat is over {chat_budget} tokens long, every answer re-reads all of it... "
+                      "A new chat would be faster and cheaper desu~")
+    return alerts
+
+class AutoVacuumSwitchJob(IdleJob):
+    """Moves the database to incremental auto_vacuum, which VacuumJob needs.
+    
+    That takes a full VACUUM, which can't be split into slices. It runs on
+    its own thread, only while Miku is hidden to the tray and no answer is
+    pending, and is interrupted as soon as the user comes back or the GUI is
+    about to write; the next hidden stretch tries again.
+    """
+    name = "vacuum_switch"
+    interval = 24 * 3600
+    idle_seconds = float("inf")
+    persistent = False
+    exclusive = True
+    max_attempts = 3
+    
+    def __init__(self):
+        self.thread = None
+        self.conn = None
+        self.interrupted = False
+        
+    def step(self, db, state):
+        state = state or {"attempts": 0}
+        if self.thread is not None:
+            if self.thread.is_alive():
+                return state, False, None
+            self.thread = None
+            self.conn.close()
+            self.conn = None
+            
+        if db.get_auto_vacuum() == 2 or state["attempts"] >= self.max_attempts:
+            return None, True, 1
+        state["attempts"] += 0 if self.interrupted else 1
+        self.interrupted = False
+        self.conn = sqlite3.connect(db.db_path, check_same_thread=False)
+        self.thread = threading.Thread(target=self.run_switch, args=(db, self.conn), daemon=True)
+        self.thread.start()
+        return state, False, None
+        
+    def run_switch(self, db, conn):
+        try:
+            db.switch_to_incremental_vacuum(conn)
+        except sqlite3.Error as e:
+            if not self.interrupted:
+                print(f"*Miku sobs* Error-chan desu... VACUUM failed: {e}")  # Debug log
+                
+    def interrupt(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.interrupted = True
+            self.conn.interrupt()
+            # Wait for the rollback, the caller is about to use the database
+            self.thread.join(2)
+
+def load_backend_factory(path):
+    """Resolve a "module:callable" string to the callable that builds a backend"""
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "ChatGPT")
+
+class HedgedBackend:
+    """Sends a request to a second backend when the first one is unusually slow.
+    
+    Looks like a single backend (it has ask()), so ChatWorker does not need to
+    know about it. The hedge fires only once the primary has gone longer than
+    the chosen percentile of recent first-token latencies without answering,
+    and never for more than max_hedge_rate of requests, so the extra cost stays
+    close to (100 - percentile)% while the slow tail gets cut off. Whichever
+    attempt finishes first wins; a streaming loser is cancelled by closing its
+    stream, a blocking one is left to finish and its answer is dropped.
+    Either way both were sent the request, so last_backends_asked tells the
+    caller how many to bill for its latest ask() on this thread.
+    
+    Backends that keep a conversation (conversation_id and parent_message_id,
+    like chatgpt_wrapper on one account) are kept on a single thread of it:
+    every attempt continues from where the last winner left off, and a loser
+    is pointed back at the winner's answer, so a hedged follow-up still has
+    the whole history. Backends without them must declare stateless = True,
+    anything else is refused because the hedge would answer without context.
+    """
+    
+    def __init__(self, backends, db, percentile=95, max_hedge_rate=0.1,
+                 default_deadline_ms=5000, min_deadline_ms=500, min_samples=20):
+        self.synced = all(all(hasattr(b, attr) for attr in PersonaSession.SESSION_ATTRS) for b in backends)
+        if not self.synced and not all(getattr(b, "stateless", False) for b in backends):
+            raise ValueError("hedging needs backends that share one conversation or are stateless")
+        self.leader = 0  # The backend whose conversation saw the last winning answer
+        self.backends = backends
+        self.locks = [threading.Lock() for _ in backends]
+        self.db = db
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.default_deadline = default_deadline_ms / 1000
+        self.min_deadline = min_deadline_ms / 1000
+        self.min_samples = min_samples
+        self.samples = deque(db.get_recent_first_token_ms(200), maxlen=200)
+        self.recent_hedges = deque(maxlen=100)
+        self.calls = threading.local()  # Several chat tabs can ask at once
+        
+    @property
+    def last_backends_asked(self):
+        return getattr(self.calls, "backends_asked", 0)
+        
+    def deadline(self):
+        if len(self.samples) < self.min_samples:
+            return self.default_deadline
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_deadline, ordered[index] / 1000)
+        
+    def hedge_allowed(self):
+        if not self.recent_hedges:
+            return True
+        return sum(self.recent_hedges) / len(self.recent_hedges) < self.max_hedge_rate
+        
+    def get_session(self, backend):
+        return {attr: getattr(backend, attr) for attr in PersonaSession.SESSION_ATTRS}
+        
+    def set_session(self, backend, session):
+        for attr, value in session.items():
+            setattr(backend, attr, value)
+            
+    def pick_backends(self):
+        """Prefer backends that are not still busy with an abandoned request"""
+        free = [i for i, lock in enumerate(self.locks) if not lock.locked()]
+        busy = [i for i in range(len(self.backends)) if i not in free]
+        return free + busy
+        
+    def ask(self, message):
+        order = self.pick_backends()
+        lock = threading.Lock()
+        first_token = threading.Event()
+        done = threading.Event()
+        attempts = []
+        result = {}
+        # Every attempt continues the conversation from the same answer
+        start = self.get_session(self.backends[self.leader]) if self.synced else None
+        
+        def primary_lost():
+            # How much longer the user would have waited (a lower bound if the primary was cut short)
+            with lock:
+                result["saved_ms"] = (time.monotonic() - result["finished"]) * 1000
+                row_id = result.get("row_id")
+            if row_id:
+                self.db.set_latency_saved(row_id, result["saved_ms"])
+                
+        def attempt(index, timing, cancel):
+            backend = self.backends[index]
+            answered = won = False
+            
+            with self.locks[index]:
+                if start is not None:
+                    self.set_session(backend, start)
+                try:
+                    ask_stream = getattr(backend, "ask_stream", None)
+                    if ask_stream:
+                        chunks = []
+                        stream = ask_stream(message)
+                        for chunk in stream:
+                            if timing["first_token"] is None:
+                                timing["first_token"] = time.monotonic()
+                                first_token.set()
+                            chunks.append(chunk)
+                            if cancel.is_set():
+                                stream.close()
+                                if index == order[0] and "finished" in result:
+                                    primary_lost()
+                                return
+                        response = "".join(chunks)
+                    else:
+                        response = backend.ask(message)
+                        timing["first_token"] = time.monotonic()
+                        first_token.set()
+                    answered = True
+                    
+                    with lock:
+                        if "response" not in result:
+                            result["response"] = response
+                            result["winner"] = index
+                            result["finished"] = time.monotonic()
+                            won = True
+                            self.leader = index
+                            done.set()
+                except Exception as e:
+                    timing["error"] = e
+                    first_token.set()
+                finally:
+                    # This conversation ends in an answer the user never saw, follow the winner's instead
+                    if start is not None and not won and self.leader != index:
+                        self.set_session(backend, self.get_session(self.backends[self.leader]))
+                        
+            if answered and not won and index == order[0]:
+                primary_lost()
+                
+        cancels = []
+        
+        def launch(index):
+            timing = {"index": index, "first_token": None, "error": None}
+            attempts.append(timing)
+            cancel = threading.Event()
+            cancels.append(cancel)
+            threading.Thread(target=attempt, args=(index, timing, cancel), daemon=True).start()
+            
+        started = time.monotonic()
+        launch(order[0])
+        hedged = False
+        
+        first_token.wait(self.deadline())
+        primary_failed = attempts[0]["error"] is not None
+        slow = not first_token.is_set() and self.hedge_allowed()
+        if len(order) > 1 and not done.is_set() and (primary_failed or slow):
+            hedged = True
+            launch(order[1])
+            
+        # Wait for a winner, or until every attempt has failed
+        while not done.wait(0.05):
+            if all(a["error"] is not None for a in attempts):
+                break
+        for cancel in cancels:
+            cancel.set()
+            
+        primary = attempts[0]
+        # A primary cancelled before its first token still tells us it was at least this slow
+        first_token_ms = ((primary["first_token"] or time.monotonic()) - started) * 1000
+        total_ms = (time.monotonic() - started) * 1000
+        winner = result.get("winner")
+        winner_slot = None if winner is None else int(winner != order[0])
+        self.samples.append(first_token_ms)
+        self.recent_hedges.append(int(hedged))
+        self.calls.backends_asked = len(attempts)
+        with lock:
+            result["row_id"] = self.db.record_latency(first_token_ms, total_ms, hedged, winner_slot,
+                                                      result.get("saved_ms"))
+            
+        if "response" not in result:
+            raise attempts[-1]["error"]
+        return result["response"]